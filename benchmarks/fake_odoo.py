@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import datetime
+import os
+import random
+import sys
+import time
+import xmlrpc.client
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from odoo_connection_handler import OdooConnectionHandler, ServerProxyPool
+
+RFID_FIELD = OdooConnectionHandler.RFID_FIELD
+OLD_WRITE_DATE = datetime.datetime(2000, 1, 1)
+
+
+def now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def old_write_date(record_id):
+    # Spread like records created over time, so only a few share the latest write_date
+    return (OLD_WRITE_DATE + datetime.timedelta(seconds=record_id)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class FakeOdooServer(object):
+    """In-memory stand-in for the Odoo XML-RPC object endpoint with synthetic students and teachers.
+
+    It answers search, search_read, read and write with the domains the caches send.
+    With ``marshal`` every answer goes through the XML-RPC encoder and decoder, so
+    serialization cost is included, and ``latency`` adds a network round trip to every call.
+    """
+
+    def __init__(self, students, teachers=None, courses=None, with_rfid=0.6, seed=1, marshal=False, latency=0.0):
+        self.marshal = marshal
+        self.latency = latency
+        self.calls = 0
+        self.tables = {"op.course": {}, "op.student.course": {}, "op.student": {}, "op.faculty": {}, "res.users": {}}
+        randomizer = random.Random(seed)
+        teachers = teachers if teachers is not None else max(10, students // 20)
+        courses = courses or max(10, students // 500)
+        for course_id in range(1, courses + 1):
+            self.tables["op.course"][course_id] = {"id": course_id, "display_name": "Course {}".format(course_id), "write_date": old_write_date(course_id)}
+
+        enrollment_id = 0
+        for student_id in range(1, students + 1):
+            user_id = student_id
+            self.__add_user(user_id, "Student {}".format(student_id), randomizer.random() < with_rfid)
+            enrollment_ids = []
+            for course_id in randomizer.sample(range(1, courses + 1), randomizer.choice((1, 1, 2))):
+                enrollment_id += 1
+                enrollment_ids.append(enrollment_id)
+                self.tables["op.student.course"][enrollment_id] = {"id": enrollment_id, "course_id": [course_id, "Course {}".format(course_id)],
+                                                                   "write_date": old_write_date(enrollment_id)}
+            self.tables["op.student"][student_id] = {"id": student_id, "display_name": "Surname {}, Student {}".format(student_id, student_id),
+                                                     "identification_code": "{:08d}S".format(student_id), "gr_no": "G{}".format(student_id),
+                                                     "course_detail_ids": enrollment_ids, "user_id": [user_id, "Student {}".format(student_id)],
+                                                     "write_date": old_write_date(student_id)}
+        for teacher_id in range(1, teachers + 1):
+            user_id = students + teacher_id
+            self.__add_user(user_id, "Teacher {}".format(teacher_id), randomizer.random() < with_rfid)
+            self.tables["op.faculty"][teacher_id] = {"id": teacher_id, "display_name": "Surname {}, Teacher {}".format(teacher_id, teacher_id),
+                                                     "identification_code": "{:08d}T".format(teacher_id), "user_id": [user_id, "Teacher {}".format(teacher_id)],
+                                                     "write_date": old_write_date(teacher_id)}
+
+    def __add_user(self, user_id, name, with_rfid):
+        self.tables["res.users"][user_id] = {"id": user_id, "display_name": name, RFID_FIELD: "{:010X}".format(user_id * 7919) if with_rfid else False,
+                                             "write_date": old_write_date(user_id)}
+
+    def touch(self, model, record_id, **values):
+        record = self.tables[model][record_id]
+        record.update(values)
+        record["write_date"] = now()
+
+    def __matches(self, record, domain):
+        for field, operator, value in domain:
+            record_value = record.get(field)
+            if isinstance(record_value, list) and field.endswith("_id"):
+                record_value = record_value[0]
+            if operator == "=" and record_value != value:
+                return False
+            if operator == ">=" and not (record_value and record_value >= value):
+                return False
+            if operator == "in" and record_value not in value:
+                return False
+        return True
+
+    def __search(self, model, domain):
+        table = self.tables[model]
+        domain = [tuple(term) for term in domain]
+        ids_terms = [value for field, operator, value in domain if field == "id" and operator == "in"]
+        domain = [term for term in domain if not (term[0] == "id" and term[1] == "in")]
+        records = table.values() if not ids_terms else (table[record_id] for record_id in ids_terms[0] if record_id in table)
+        if domain:
+            domain = [(field, operator, set(value) if operator == "in" else value) for field, operator, value in domain]
+            records = (record for record in records if self.__matches(record, domain))
+        return list(records)
+
+    def __project(self, record, fields):
+        if not fields:
+            return dict(record)
+        projected = {"id": record["id"]}
+        for field in fields:
+            projected[field] = record.get(field, False)
+        return projected
+
+    def __answer(self, result):
+        if self.marshal:
+            return xmlrpc.client.loads(xmlrpc.client.dumps((result,), methodresponse=True, allow_none=True))[0][0]
+        return result
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        kwargs = kwargs or {}
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "search":
+            return self.__answer([record["id"] for record in self.__search(model, args[0])])
+        if method == "search_read":
+            return self.__answer([self.__project(record, kwargs.get("fields")) for record in self.__search(model, args[0])])
+        if method == "read":
+            table = self.tables[model]
+            return self.__answer([self.__project(table[record_id], kwargs.get("fields")) for record_id in args[0] if record_id in table])
+        if method == "write":
+            record_ids, values = args
+            for record_id in record_ids:
+                self.touch(model, record_id, **values)
+            return True
+        raise xmlrpc.client.Fault(1, "Method '{}' is not supported by the fake server".format(method))
+
+
+class FakeOdooHandler(object):
+    """What OdooConnectionHandler uses of an authenticated OdooHandler."""
+
+    RFID_VAR = RFID_FIELD
+
+    def __init__(self, server):
+        self.url = "fake://odoo"
+        self.db = "benchmark"
+        self.uid = 1
+        self.password = "benchmark"
+        self.self_signed_certificate = False
+        self.models = server
+
+
+def make_connection(server, pool_size=OdooConnectionHandler.DEFAULT_POOL_SIZE):
+    odoo_connection = OdooConnectionHandler("fake://odoo", "benchmark", "benchmark", "benchmark", pool_size=pool_size)
+    odoo_connection.connection = FakeOdooHandler(server)
+    odoo_connection.pool = ServerProxyPool(lambda: server, pool_size)
+    return odoo_connection
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Throughput of the handlers against a fake Odoo server with synthetic students and teachers.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json
+
+With --baseline the run fails (exit code 1) if a benchmark is slower than the saved one
+by more than --tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from fake_odoo import make_connection, FakeOdooServer
+
+from odoo_repository import OdooRepository
+from students_handler import StudentsHandler
+from table_view import TableView
+from teachers_handler import TeachersHandler
+from timing import timings
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+
+
+class Benchmark(object):
+    def __init__(self, size):
+        self.size = size
+        self.results = {}
+
+    def measure(self, name, function, items):
+        started_at = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started_at
+        self.results[name] = {"seconds": elapsed, "items": items, "items_per_second": items / elapsed if elapsed else 0.0}
+        print("  {:<28} {:>9.3f}s {:>14,.0f} items/s".format(name, elapsed, self.results[name]["items_per_second"]))
+
+
+def write_import_file(file_path, handler, rows):
+    people = [student for student in handler.all_students.values() if not student.rfid_code][:rows]
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(handler.csv_headline + "\n")
+        for index, student in enumerate(people):
+            f.write("{},{},{},,NEW{:08d}\n".format(student.name.replace(",", ""), student.identification_code, student.student_code, index))
+    return len(people)
+
+
+def run_size(size, marshal, latency, directory):
+    print("{:,} students".format(size))
+    benchmark = Benchmark(size)
+    server = FakeOdooServer(size, marshal=marshal)
+    odoo_connection = make_connection(server)
+    repository = OdooRepository(odoo_connection, ttl=0)
+    students_handler = StudentsHandler(odoo_connection, repository)
+    teachers_handler = TeachersHandler(odoo_connection, repository)
+
+    benchmark.measure("students_full_refresh", lambda: students_handler.refresh_students(), size)
+    benchmark.measure("teachers_full_refresh", lambda: teachers_handler.refresh_teachers(), len(server.tables["op.faculty"]))
+    changed_users = list(server.tables["res.users"])[::100]
+    for user_id in changed_users:
+        server.touch("res.users", user_id, **{odoo_connection.RFID_FIELD: "CHANGED{}".format(user_id)})
+    benchmark.measure("students_delta_refresh", lambda: students_handler.refresh_students(incremental=True), len(changed_users))
+
+    course_names = students_handler.get_courses_names()
+
+    def filter_all_courses():
+        for course_name in course_names:
+            students_handler.filter(course_name, True)
+            students_handler.filter(course_name, False)
+        students_handler.filter()
+    benchmark.measure("filter_courses", filter_all_courses, len(course_names) * 2)
+    students_handler.filtered_views.clear()
+    students_handler.filter()
+    benchmark.measure("build_list", students_handler.build_list, size)
+
+    table_view = TableView([0, 1, 2])
+
+    def sort_and_search():
+        table_view.set_data(list(students_handler.selected_students.keys()), students_handler.build_list())
+        table_view.sort(0)
+        for text in ("s", "su", "sur", "surname 1"):
+            table_view.search(text)
+        table_view.get_page_rows()
+    benchmark.measure("table_sort_search", sort_and_search, size)
+
+    for file_format in ("csv", "json"):
+        file_path = os.path.join(directory, "students.{}".format(file_format))
+        benchmark.measure("export_" + file_format, lambda: students_handler.export(file_path), size)
+
+    import_path = os.path.join(directory, "import.csv")
+    rows = write_import_file(import_path, students_handler, max(1, size // 10))
+    benchmark.measure("import_csv", lambda: students_handler.import_csv(import_path), rows)
+    benchmark.measure("diff_csv", lambda: students_handler.diff_csv(import_path), rows)
+    new_rfid_codes = students_handler.import_csv(import_path).new_rfid_codes
+    writes = dict(list(new_rfid_codes.items())[:1000])
+    # Every write is a round trip to Odoo, so only the writes pay the simulated latency
+    server.latency = latency
+    benchmark.measure("write_rfid_codes", lambda: students_handler.write_rfid_codes(writes), len(writes))
+    return benchmark.results
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous and result["seconds"] > previous["seconds"] * (1 + tolerance):
+                regressions.append("{} ({} students): {:.3f}s, was {:.3f}s".format(name, size, result["seconds"], previous["seconds"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the handlers against a fake Odoo server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Numbers of students (default: %(default)s)")
+    parser.add_argument("--marshal", action="store_true", help="Encode and decode every answer as XML-RPC")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every Odoo call while writing (default: %(default)s)")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline (default: %(default)s)")
+    parser.add_argument("--timings", action="store_true", help="Print the time spent in every span")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            results[str(size)] = run_size(size, args.marshal, args.latency, directory)
+
+    if args.timings:
+        print(timings.summary())
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Slower: " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task(object):
+    def __init__(self, event_key, description):
+        self.event_key = event_key
+        self.description = description
+        self.cancel_requested = threading.Event()
+        self.started = False
+        self.result = None
+        self.error = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancel_requested.set()
+
+
+class TaskRunner(object):
+    """Runs Odoo operations in worker threads and posts their outcome as window events.
+
+    Submitted functions receive a ``progress(done, total)`` keyword argument. Calling it
+    reports progress to the window and raises TaskCancelled once the task has been
+    cancelled, so work stops at the next checkpoint.
+
+    The workers are daemon threads: closing the window never waits for an Odoo call in
+    progress, and RFID writes are kept by the journal, not by these tasks.
+    """
+
+    PROGRESS_EVENT = "task_progress"
+    DEFAULT_MAX_WORKERS = 4
+
+    def __init__(self, window, max_workers=DEFAULT_MAX_WORKERS):
+        self.window = window
+        self.running_tasks = []
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        # ThreadPoolExecutor joins its workers at exit, which would wait for the Odoo call in progress
+        self.workers = [threading.Thread(target=self.__work, name="task-runner-{}".format(index), daemon=True) for index in range(max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, event_key, description, function, *args):
+        task = Task(event_key, description)
+        self.running_tasks.append(task)
+        self.pending.put((task, function, args))
+        return task
+
+    def __work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            task, function, args = item
+            with self.lock:
+                if task.cancelled:
+                    continue
+                task.started = True
+            self.__run(task, function, args)
+
+    def __run(self, task, function, args):
+        def progress(done, total):
+            if task.cancel_requested.is_set():
+                raise TaskCancelled()
+            self.window.write_event_value(self.PROGRESS_EVENT, (task, done, total))
+
+        try:
+            task.result = function(*args, progress=progress)
+        except TaskCancelled:
+            logger.info("Task '{}' cancelled".format(task.description))
+            task.cancelled = True
+        except Exception as e:
+            logger.exception("Task '{}' failed".format(task.description))
+            task.error = e
+        self.window.write_event_value(task.event_key, task)
+
+    def finish(self, task):
+        if task in self.running_tasks:
+            self.running_tasks.remove(task)
+
+    def is_busy(self):
+        return bool(self.running_tasks)
+
+    def cancel_all(self):
+        for task in list(self.running_tasks):
+            task.cancel()
+            with self.lock:
+                never_started = not task.started and not task.cancelled
+                if never_started:
+                    task.cancelled = True
+            if never_started:
+                # Nobody else is going to post its event
+                self.window.write_event_value(task.event_key, task)
+
+    def shutdown(self):
+        self.cancel_all()
+        for _ in self.workers:
+            self.pending.put(None)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import socket
+import sys
+import xmlrpc.client
+from odoo_connection_handler import CONNECTION_ERRORS, OdooConnectionHandler
+from odoo_repository import OdooRepository
+from snapshot_store import SnapshotStore
+from students_handler import StudentsHandler
+from teachers_handler import TeachersHandler
+from timing import timings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".ule-rfid-manager", "config.ini")
+ENVIRONMENT_PREFIX = "ULE_RFID_"
+
+EXIT_OK = 0
+EXIT_PARTIAL_FAILURE = 1
+EXIT_USAGE_ERROR = 2
+EXIT_CONNECTION_ERROR = 3
+EXIT_INPUT_ERROR = 4
+
+
+class CliError(Exception):
+    def __init__(self, message, exit_code):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+def load_settings(args):
+    """Connection settings from the command line, then the environment (ULE_RFID_*), then the config file."""
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    file_settings = config["odoo"] if config.has_section("odoo") else {}
+    settings = {}
+    for name in ("url", "db", "username", "password", "self_signed", "timeout"):
+        value = getattr(args, name)
+        if value is None:
+            value = os.environ.get(ENVIRONMENT_PREFIX + name.upper())
+        if value is None:
+            value = file_settings.get(name)
+        settings[name] = value
+    settings["self_signed"] = str(settings["self_signed"]).lower() in ("1", "true", "yes")
+    try:
+        settings["timeout"] = float(settings["timeout"]) if settings["timeout"] else OdooConnectionHandler.DEFAULT_TIMEOUT
+    except ValueError:
+        raise CliError("Invalid timeout '{}'".format(settings["timeout"]), EXIT_USAGE_ERROR)
+    missing = [name for name in ("url", "db", "username", "password") if not settings[name]]
+    if missing:
+        raise CliError("Missing connection settings: {}".format(", ".join(missing)), EXIT_USAGE_ERROR)
+    return settings
+
+
+def connect(args, url=None, db=None):
+    settings = load_settings(args)
+    settings["url"] = url or settings["url"]
+    settings["db"] = db or settings["db"]
+    odoo_connection = OdooConnectionHandler(settings["url"], settings["db"], settings["username"], settings["password"], settings["self_signed"],
+                                            timeout=settings["timeout"])
+    try:
+        odoo_connection.connect()
+    except (AttributeError, ConnectionError, socket.gaierror, xmlrpc.client.Error, OSError) as e:
+        raise CliError("Connection to '{}' ({}) failed: {}".format(settings["url"], settings["db"], e), EXIT_CONNECTION_ERROR)
+    return odoo_connection
+
+
+def load_handler(args, odoo_connection):
+    snapshot_store = None if args.no_cache else SnapshotStore(odoo_connection.url, odoo_connection.db)
+    repository = OdooRepository(odoo_connection, snapshot_store)
+    # Students and teachers share the users snapshot, which only keeps the users of the
+    # people that are loaded: both are loaded so the next run of the other kind can use it
+    students_handler = StudentsHandler(odoo_connection, repository)
+    teachers_handler = TeachersHandler(odoo_connection, repository)
+    students_handler.refresh_students(incremental=True)
+    teachers_handler.refresh_teachers(incremental=True)
+    if args.kind == "students":
+        handler = students_handler
+        handler.filter(getattr(args, "course", "") or "", not getattr(args, "without_rfid", False))
+        people = handler.all_students
+    else:
+        handler = teachers_handler
+        handler.filter(not getattr(args, "without_rfid", False))
+        people = handler.all_teachers
+    return handler, people
+
+
+def import_file(handler, file_path):
+    try:
+        return handler.import_csv(file_path)
+    except (AttributeError, OSError) as e:
+        raise CliError("'{}' could not be imported: {}".format(file_path, e), EXIT_INPUT_ERROR)
+
+
+def write_rfid_codes(handler, result, rfid_codes):
+    write_results = handler.write_rfid_codes(rfid_codes) if rfid_codes else {}
+    failed = [person_id for person_id, success in write_results.items() if not success]
+    result["written"] = len(write_results) - len(failed)
+    result["failed"] = failed
+    return result, EXIT_PARTIAL_FAILURE if failed else EXIT_OK
+
+
+def write_report(handler, import_report):
+    return write_rfid_codes(handler, import_report.to_dict(), import_report.new_rfid_codes)
+
+
+def diff_source(args, handler):
+    if args.source_db or args.source_url:
+        source_connection = connect(args, args.source_url, args.source_db)
+        _, source_people = load_handler(args, source_connection)
+        source = "{} ({})".format(source_connection.url, source_connection.db)
+        if args.kind == "students":
+            return handler.diff_students(source_people, source)
+        return handler.diff_teachers(source_people, source)
+    if not args.file:
+        raise CliError("A file or a source database is needed", EXIT_USAGE_ERROR)
+    try:
+        return handler.diff_csv(args.file)
+    except (AttributeError, OSError) as e:
+        raise CliError("'{}' could not be read: {}".format(args.file, e), EXIT_INPUT_ERROR)
+
+
+def command_export(args, odoo_connection):
+    handler, _ = load_handler(args, odoo_connection)
+    columns = args.columns.split(",") if args.columns else None
+    try:
+        handler.export(args.output, columns, args.format)
+    except (AttributeError, KeyError, OSError) as e:
+        raise CliError("Export failed: {}".format(e), EXIT_INPUT_ERROR)
+    selected = handler.selected_students if args.kind == "students" else handler.selected_teachers
+    return {"file": args.output, "rows": len(selected)}, EXIT_OK
+
+
+def command_import(args, odoo_connection):
+    handler, _ = load_handler(args, odoo_connection)
+    import_report = import_file(handler, args.file)
+    if args.dry_run:
+        return import_report.to_dict(), EXIT_OK
+    return write_report(handler, import_report)
+
+
+def command_diff(args, odoo_connection):
+    handler, _ = load_handler(args, odoo_connection)
+    diff_report = diff_source(args, handler)
+    if not args.apply:
+        return diff_report.to_dict(), EXIT_OK
+    try:
+        person_ids = {int(person_id) for person_id in args.ids.split(",")} if args.ids else None
+        rfid_codes = diff_report.select(args.apply.split(","), person_ids)
+    except (AttributeError, ValueError) as e:
+        raise CliError("Invalid selection of changes: {}".format(e), EXIT_USAGE_ERROR)
+    return write_rfid_codes(handler, diff_report.to_dict(), rfid_codes)
+
+
+def command_sync(args, odoo_connection):
+    handler, people = load_handler(args, odoo_connection)
+    result = {"people": len(people), "with_rfid": sum(1 for person in people.values() if person.rfid_code)}
+    exit_code = EXIT_OK
+    if args.file:
+        result["import"], exit_code = write_report(handler, import_file(handler, args.file))
+    return result, exit_code
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ule-rfid-manager-cli", description="Headless RFID synchronization with Odoo")
+    parser.add_argument("--url", help="Odoo server (env: ULE_RFID_URL)")
+    parser.add_argument("--db", help="Odoo database (env: ULE_RFID_DB)")
+    parser.add_argument("--username", help="Odoo user (env: ULE_RFID_USERNAME)")
+    parser.add_argument("--password", help="Odoo password (env: ULE_RFID_PASSWORD)")
+    parser.add_argument("--self-signed", dest="self_signed", action="store_const", const="true", default=None,
+                        help="Accept self signed certificates (env: ULE_RFID_SELF_SIGNED)")
+    parser.add_argument("--timeout", help="Seconds to wait for each Odoo call (env: ULE_RFID_TIMEOUT)")
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH, help="INI file with an [odoo] section (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="Do not use the local snapshot")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--timings", default=os.environ.get(ENVIRONMENT_PREFIX + "TIMINGS"),
+                        help="At exit print the time spent in each phase ('summary') or save it as JSON to this file (env: ULE_RFID_TIMINGS)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export", help="Export students or teachers")
+    export_parser.add_argument("kind", choices=["students", "teachers"])
+    export_parser.add_argument("output", help="Destination file (.csv, .xlsx or .json)")
+    export_parser.add_argument("--format", choices=["csv", "xlsx", "json"])
+    export_parser.add_argument("--columns", help="Comma separated export columns")
+    export_parser.add_argument("--course", help="Only students of this course")
+    export_parser.add_argument("--without-rfid", action="store_true", help="Only people without RFID")
+    export_parser.set_defaults(function=command_export)
+
+    import_parser = subparsers.add_parser("import", help="Import RFID codes from a CSV file")
+    import_parser.add_argument("kind", choices=["students", "teachers"])
+    import_parser.add_argument("file")
+    import_parser.add_argument("--dry-run", action="store_true", help="Validate the file without writing to Odoo")
+    import_parser.set_defaults(function=command_import)
+
+    diff_parser = subparsers.add_parser("diff", help="Compare the RFID codes of a CSV file or another database with the current ones")
+    diff_parser.add_argument("kind", choices=["students", "teachers"])
+    diff_parser.add_argument("file", nargs="?")
+    diff_parser.add_argument("--source-db", help="Compare with this database instead of a file, matching people by DNI")
+    diff_parser.add_argument("--source-url", help="Server of the source database (default: the same server)")
+    diff_parser.add_argument("--apply", help="Write these comma separated kinds of changes: added, changed")
+    diff_parser.add_argument("--ids", help="Only apply the changes of these comma separated people ids")
+    diff_parser.set_defaults(function=command_diff)
+
+    sync_parser = subparsers.add_parser("sync", help="Synchronize the local snapshot and optionally import a CSV file")
+    sync_parser.add_argument("kind", choices=["students", "teachers"])
+    sync_parser.add_argument("file", nargs="?")
+    sync_parser.set_defaults(function=command_sync)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(levelname)-6s - %(name)-16s - %(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+    timings.dump_at_exit(args.timings)
+    try:
+        odoo_connection = connect(args)
+        try:
+            result, exit_code = args.function(args, odoo_connection)
+        except (xmlrpc.client.Error,) + CONNECTION_ERRORS as e:
+            raise CliError("Odoo request failed: {}".format(e), EXIT_CONNECTION_ERROR)
+    except CliError as e:
+        print(json.dumps({"error": str(e)}), file=sys.stdout)
+        return e.exit_code
+    for name, stats in timings.to_dict().items():
+        if name.startswith("odoo."):
+            logger.info("{}: {count} call(s), {average_time:.3f}s average, {max_time:.3f}s max".format(name, **stats))
+    print(json.dumps(result, ensure_ascii=False, indent=2, default=str))
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import codecs
+import csv
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+RFID_PATTERN = re.compile(r"^[0-9A-Za-z]{4,32}$")
+SAMPLE_SIZE = 64 * 1024
+
+
+class ImportReport(object):
+    """Outcome of an RFID import: accepted codes plus every skipped row with its line number and reason."""
+
+    def __init__(self, file_path=""):
+        self.file_path = file_path
+        self.accepted = {}
+        self.already_assigned = []
+        self.unknown_person = []
+        self.duplicate_card = []
+        self.invalid = []
+        self.without_rfid = 0
+
+    @property
+    def new_rfid_codes(self):
+        return dict(self.accepted)
+
+    def skipped_rows(self):
+        return len(self.already_assigned) + len(self.unknown_person) + len(self.duplicate_card) + len(self.invalid)
+
+    def summary(self):
+        return ("{} new RFID code(s)\n"
+                "{} row(s) of people that already have a card\n"
+                "{} row(s) of unknown people\n"
+                "{} row(s) with a card assigned to someone else\n"
+                "{} invalid row(s)\n"
+                "{} row(s) without RFID").format(len(self.accepted), len(self.already_assigned), len(self.unknown_person),
+                                                  len(self.duplicate_card), len(self.invalid), self.without_rfid)
+
+    def to_dict(self):
+        return {
+            "file": self.file_path,
+            "accepted": [{"id": person_id, "rfid": rfid_code} for person_id, rfid_code in self.accepted.items()],
+            "already_assigned": self.already_assigned,
+            "unknown_person": self.unknown_person,
+            "duplicate_card": self.duplicate_card,
+            "invalid": self.invalid,
+            "without_rfid": self.without_rfid,
+        }
+
+
+def detect_encoding(sample):
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # Incremental decoding: the sample may end in the middle of a multibyte character
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        # Spreadsheets saved on Windows
+        return "cp1252"
+
+
+def detect_dialect(text_sample):
+    try:
+        return csv.Sniffer().sniff(text_sample, delimiters=",;\t")
+    except csv.Error:
+        return csv.excel
+
+
+def read_csv_rows(file_path, columns):
+    """Yield (line_number, row_dict) for every data row of the file, after checking its headline against the expected columns."""
+    if not file_path:
+        raise AttributeError("No file selected")
+
+    with open(file_path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    encoding = detect_encoding(sample)
+
+    with open(file_path, "r", encoding=encoding, errors="replace", newline="") as f:
+        dialect = detect_dialect(f.read(SAMPLE_SIZE))
+        f.seek(0)
+        reader = csv.reader(f, dialect)
+        headline = next(reader, None)
+        if headline is None:
+            raise AttributeError("No valid data")
+        if [column.strip() for column in headline] != columns:
+            raise AttributeError("Invalid headline format")
+
+        for row in reader:
+            if not any(value.strip() for value in row):
+                continue
+            yield reader.line_num, row
+
+
+def import_rfid_codes(file_path, columns, find_person, get_person_rfid, find_rfid_owner, rfid_column="RFID"):
+    """Check every row of an RFID CSV against the local people.
+
+    ``find_person(row)`` returns the id of the person of a row (a dict by column name),
+    ``get_person_rfid(person_id)`` the card that person already has and
+    ``find_rfid_owner(rfid_code)`` who owns a card.
+    """
+    report = ImportReport(file_path)
+    file_rfid_owners = {}
+    has_rows = False
+    for line_number, values in read_csv_rows(file_path, columns):
+        has_rows = True
+        if len(values) != len(columns):
+            report.invalid.append({"line": line_number, "reason": "expected {} columns, found {}".format(len(columns), len(values))})
+            continue
+        row = {column: value.strip() for column, value in zip(columns, values)}
+        rfid_code = row.get(rfid_column)
+        if not rfid_code:
+            report.without_rfid += 1
+            continue
+        if not RFID_PATTERN.match(rfid_code):
+            report.invalid.append({"line": line_number, "reason": "invalid RFID code '{}'".format(rfid_code)})
+            continue
+
+        person_id = find_person(row)
+        if person_id is None:
+            report.unknown_person.append({"line": line_number, "row": row})
+            continue
+        current_rfid_code = get_person_rfid(person_id) or report.accepted.get(person_id)
+        if current_rfid_code:
+            report.already_assigned.append({"line": line_number, "id": person_id, "rfid": current_rfid_code})
+            continue
+        rfid_owner_id = find_rfid_owner(rfid_code)
+        if rfid_owner_id is None:
+            rfid_owner_id = file_rfid_owners.get(rfid_code)
+        if rfid_owner_id is not None and rfid_owner_id != person_id:
+            report.duplicate_card.append({"line": line_number, "id": person_id, "rfid": rfid_code, "owner": rfid_owner_id})
+            continue
+
+        file_rfid_owners[rfid_code] = person_id
+        report.accepted[person_id] = rfid_code
+
+    if not has_rows:
+        raise AttributeError("No valid data")
+    logger.info("Import of '{}': {} accepted, {} skipped".format(file_path, len(report.accepted), report.skipped_rows()))
+    return report
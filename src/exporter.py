@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import logging
+import os
+import tempfile
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("csv", "xlsx", "json")
+
+# Read once, as os.umask can only be read by setting it
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+
+def get_available_formats():
+    """Return the export formats whose packages are installed."""
+    return tuple(file_format for file_format in EXPORT_FORMATS if file_format != "xlsx" or openpyxl is not None)
+
+
+def get_file_format(file_path, file_format=None):
+    file_format = (file_format or os.path.splitext(file_path)[1].lstrip(".") or "csv").lower()
+    if file_format not in EXPORT_FORMATS:
+        raise AttributeError("Unsupported export format '{}'".format(file_format))
+    if file_format == "xlsx" and openpyxl is None:
+        raise AttributeError("Exporting to XLSX requires the 'openpyxl' package")
+    return file_format
+
+
+def write_csv_file(temp_file, headings, rows):
+    # BOM so that spreadsheets detect UTF-8; the importer skips it
+    with os.fdopen(temp_file, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(headings)
+        writer.writerows(rows)
+
+
+def write_json_file(temp_file, headings, rows):
+    with os.fdopen(temp_file, "w", encoding="utf-8") as f:
+        f.write("[")
+        for index, row in enumerate(rows):
+            f.write(",\n" if index else "\n")
+            f.write(json.dumps(dict(zip(headings, row)), ensure_ascii=False))
+        f.write("\n]\n")
+
+
+def write_xlsx_file(temp_file, temp_path, headings, rows):
+    os.close(temp_file)
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    worksheet.append(headings)
+    for row in rows:
+        worksheet.append(list(row))
+    workbook.save(temp_path)
+
+
+def export_rows(file_path, headings, rows, file_format=None):
+    """Stream the rows into file_path as CSV, XLSX or JSON (taken from the extension if not given).
+
+    The file is written next to its destination and renamed at the end, so a failed
+    export never leaves a half written file behind.
+    """
+    if not file_path:
+        raise AttributeError("No file selected")
+    file_format = get_file_format(file_path, file_format)
+    directory = os.path.dirname(os.path.abspath(file_path))
+    temp_file, temp_path = tempfile.mkstemp(dir=directory, prefix=".export-", suffix=".tmp")
+    try:
+        if file_format == "csv":
+            write_csv_file(temp_file, headings, rows)
+        elif file_format == "json":
+            write_json_file(temp_file, headings, rows)
+        else:
+            write_xlsx_file(temp_file, temp_path, headings, rows)
+        # mkstemp creates the file as 0600: give it the mode that open() would
+        if os.path.exists(file_path):
+            os.chmod(temp_path, os.stat(file_path).st_mode & 0o7777)
+        else:
+            os.chmod(temp_path, 0o666 & ~FILE_UMASK)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    logger.info("Exported to '{}'".format(file_path))
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 
+from background_tasks import TaskRunner
+from exporter import get_available_formats
 import logging
+import os
 import socket
 from odoo_connection_handler import OdooConnectionHandler
+from odoo_repository import OdooRepository
 import PySimpleGUI as sg
+from rfid_reader import RfidDebouncer, RfidReader, normalize_rfid
+from rfid_journal import RfidJournal
+from rfid_write_queue import RfidWriteQueue
+from snapshot_store import SnapshotStore
 from students_handler import StudentsHandler
 from teachers_handler import TeachersHandler
 import sys
+from table_view import TableView
+import time
+from timing import span, timings
 import xmlrpc
 
 logging.basicConfig(format='%(asctime)s %(levelname)-6s - %(name)-16s - %(message)s', level=logging.INFO)
@@ -23,6 +34,12 @@ course_names = [default_course_filter]
 teachers_headings = ["Name", "DNI", "RFID"]
 teachers_data = [["" for i in range(len(teachers_headings))]]
 
+# Excel is only offered when openpyxl is installed
+export_file_types = tuple(file_type for file_format, file_type in (("csv", ("CSV", "*.csv")), ("xlsx", ("Excel", "*.xlsx")), ("json", ("JSON", "*.json")))
+                          if file_format in get_available_formats())
+no_sorting = "None"
+search_delay = 0.3 # seconds without typing before searching
+
 login_layout = [[sg.Text("Odoo server"), sg.InputText(ODOO_DEFAULT_URL)],
                  [sg.Text("Database"), sg.InputText(ODOO_DEFAULT_DB), sg.Checkbox('Self signed certificate', default=True)],
                  [sg.Text("Username"), sg.InputText()],
@@ -30,23 +47,198 @@ login_layout = [[sg.Text("Odoo server"), sg.InputText(ODOO_DEFAULT_URL)],
                  [sg.Button("Exit"), sg.Button("Login")],
                  [sg.Text("", key="error_message", visible=False, background_color="red", text_color="white", size=(70,1))]]
 
-students_tab_layout = [[sg.Button("Refresh", key="refresh_students"), sg.Button("Export", key="export_students"), sg.Button("Import", key="import_students"), sg.Checkbox('Show users with RFID', key="students_with_rfid", default=True, enable_events=True)],
+students_tab_layout = [[sg.Button("Refresh", key="refresh_students"), sg.Button("Full reload", key="reload_students"), sg.Button("Export", key="export_students"), sg.Button("Import", key="import_students"), sg.Checkbox('Show users with RFID', key="students_with_rfid", default=True, enable_events=True)],
                         [sg.Text("Course filter"), sg.Combo(course_names, key='course_filter', default_value="All", size=(55,1), enable_events=True)],
+                        [sg.Text("Search"), sg.Input(key="students_search", size=(30,1), enable_events=True), sg.Text("Sort by"), sg.Combo([no_sorting] + students_headings, key="students_sort", default_value=no_sorting, readonly=True, enable_events=True),
+                         sg.Checkbox("Descending", key="students_sort_reverse", enable_events=True), sg.Button("<", key="students_previous_page"), sg.Text("", key="students_page", size=(25,1)), sg.Button(">", key="students_next_page")],
                         [sg.Table(values=students_data, headings=students_headings, enable_events=True,  col_widths=[20,15,15,15,30],
                         num_rows=30, justification='center', auto_size_columns=False, key='students')]]
-teachers_tab_layout = [[sg.Button("Refresh", key="refresh_teachers"), sg.Button("Export", key="export_teachers"), sg.Button("Import", key="import_teachers"), sg.Checkbox('Show users with RFID', key="teachers_with_rfid", default=True, enable_events=True)],
+teachers_tab_layout = [[sg.Button("Refresh", key="refresh_teachers"), sg.Button("Full reload", key="reload_teachers"), sg.Button("Export", key="export_teachers"), sg.Button("Import", key="import_teachers"), sg.Checkbox('Show users with RFID', key="teachers_with_rfid", default=True, enable_events=True)],
+                        [sg.Text("Search"), sg.Input(key="teachers_search", size=(30,1), enable_events=True), sg.Text("Sort by"), sg.Combo([no_sorting] + teachers_headings, key="teachers_sort", default_value=no_sorting, readonly=True, enable_events=True),
+                         sg.Checkbox("Descending", key="teachers_sort_reverse", enable_events=True), sg.Button("<", key="teachers_previous_page"), sg.Text("", key="teachers_page", size=(25,1)), sg.Button(">", key="teachers_next_page")],
                         [sg.Table(values=teachers_data, headings=teachers_headings, enable_events=True,  col_widths=[20,15,15,15,30],
                         num_rows=30, justification='center', auto_size_columns=False, key='teachers')]]
 
-main_layout = [[sg.TabGroup([[sg.Tab("Students", students_tab_layout), sg.Tab('Teachers', teachers_tab_layout)]])]]
+main_layout = [[sg.TabGroup([[sg.Tab("Students", students_tab_layout, key="students_tab"), sg.Tab('Teachers', teachers_tab_layout, key="teachers_tab")]], key="tabs")],
+               [sg.Text("Card reader"), sg.Input(key="reader_device", size=(25,1)), sg.Button("Connect", key="connect_reader"),
+                sg.Text("Scan"), sg.Input(key="scan_input", size=(20,1)), sg.Text("", key="scan_status", size=(60,1))],
+               [sg.Text("", key="task_status", size=(60,1)), sg.ProgressBar(1, orientation='h', size=(20,15), key="task_progress"), sg.Button("Cancel", key="cancel_tasks", disabled=True)]]
+
+students_tab_keys = ["refresh_students", "reload_students", "export_students", "import_students", "students_with_rfid", "course_filter"]
+teachers_tab_keys = ["refresh_teachers", "reload_teachers", "export_teachers", "import_teachers", "teachers_with_rfid"]
+task_tab_keys = {
+    "students_refreshed": students_tab_keys,
+    "teachers_refreshed": teachers_tab_keys,
+}
+
+# Only one page of rows is sent to each table. Searchable columns: name, DNI and student code
+table_views = {
+    "students": TableView([0, 1, 2]),
+    "teachers": TableView([0, 1]),
+}
+pending_searches = {}
+
+# Cards read by the serial reader or typed by a keyboard-wedge reader into scan_input
+scan_debouncer = RfidDebouncer()
+rfid_reader = None
 
 is_logged = False
 are_students_loaded = False
 are_teachers_loaded = False
 
 
+def set_tab_enabled(window, keys, enabled):
+    for key in keys:
+        window[key].update(disabled=not enabled)
+
+
+def show_page(window, table_key):
+    table_view = table_views[table_key]
+    with span("gui.render"):
+        window[table_key].update(values=table_view.get_page_rows())
+        window[table_key + "_page"].update(table_view.get_page_label())
+
+
+def show_selection(window, table_key, selected_ids, rows):
+    with span("gui.table_view"):
+        table_views[table_key].set_data(selected_ids, rows)
+    show_page(window, table_key)
+
+
+def show_students(window, students_handler):
+    show_selection(window, "students", list(students_handler.selected_students.keys()), students_handler.build_list())
+
+
+def show_teachers(window, teachers_handler):
+    show_selection(window, "teachers", list(teachers_handler.selected_teachers.keys()), teachers_handler.build_list())
+
+
+def handle_table_view_event(window, event, values):
+    table_key, action = event.split("_", 1)
+    table_view = table_views[table_key]
+    if action == "search":
+        # Debounced: applied from the event loop once the user stops typing
+        pending_searches[table_key] = (values.get(event), time.monotonic())
+        return
+    if action in ("sort", "sort_reverse"):
+        sort_column = values.get(table_key + "_sort")
+        headings = students_headings if table_key == "students" else teachers_headings
+        column = headings.index(sort_column) if sort_column in headings else None
+        table_view.sort(column, values.get(table_key + "_sort_reverse"))
+    elif action == "previous_page":
+        table_view.previous_page()
+    elif action == "next_page":
+        table_view.next_page()
+    show_page(window, table_key)
+
+
+def apply_pending_searches(window):
+    now = time.monotonic()
+    for table_key, (search_text, typed_at) in list(pending_searches.items()):
+        if now - typed_at >= search_delay:
+            del pending_searches[table_key]
+            table_views[table_key].search(search_text)
+            show_page(window, table_key)
+
+
+def assign_scanned_rfid(window, values, handlers, task_runner, write_queue, rfid_code):
+    # The card goes to the selected row of the visible tab and the selection moves to the next row
+    table_key = "teachers" if values.get("tabs") == "teachers_tab" else "students"
+    table_view = table_views[table_key]
+    page_ids = table_view.get_page_ids()
+    selected_rows = values.get(table_key) or []
+    if task_runner.is_busy():
+        window['scan_status'].update("Wait until the current task finishes to assign the card '{}'".format(rfid_code))
+        return
+    if not selected_rows or selected_rows[0] >= len(page_ids):
+        window['scan_status'].update("Select a row before scanning the card '{}'".format(rfid_code))
+        return
+    for other_key, other_handler in handlers.items():
+        if other_key != table_key and other_handler.find_rfid_owner(rfid_code) is not None:
+            window['scan_status'].update("The card '{}' is already assigned to one of the {}".format(rfid_code, other_key))
+            return
+    if write_queue.journal.find_pending_owner(rfid_code) is not None:
+        window['scan_status'].update("The card '{}' is already waiting to be written to another user".format(rfid_code))
+        return
+    person_id = page_ids[selected_rows[0]]
+    try:
+        person = handlers[table_key].assign_rfid(person_id, rfid_code)
+    except AttributeError as e:
+        window['scan_status'].update(str(e))
+        return
+    write_queue.put(person.user_id, rfid_code)
+    table_view.update_row(person_id, person.to_array())
+    next_row = min(selected_rows[0] + 1, len(page_ids) - 1)
+    window[table_key].update(values=table_view.get_page_rows(), select_rows=[next_row])
+    window['scan_status'].update("Card '{}' assigned to {} ({} pending)".format(rfid_code, person.name, write_queue.pending_count()))
+
+
+def toggle_rfid_reader(window, device_path):
+    global rfid_reader
+    if rfid_reader and rfid_reader.is_running():
+        rfid_reader.stop()
+        window['connect_reader'].update("Connect")
+        return
+    rfid_reader = RfidReader(device_path, lambda rfid_code: window.write_event_value("rfid_scanned", rfid_code),
+                             lambda error: window.write_event_value("rfid_reader_failed", error), scan_debouncer)
+    rfid_reader.start()
+    window['connect_reader'].update("Disconnect")
+
+
+def report_flushed_writes(repository, outcome):
+    rejected = [user_id for user_id, status in outcome.items() if status in (RfidJournal.CONFLICT, RfidJournal.FAILED)]
+    if rejected:
+        # Their cards were only assigned locally and their write_date did not change: read them again
+        repository.mark_stale("res.users", rejected)
+        sg.popup("{} card(s) could not be written to Odoo, because Odoo had other values or rejected them. "
+                 "Refresh to see the stored values".format(len(rejected)), title="Error")
+
+
+def queue_imported_rfid_codes(handlers, table_key, write_queue, new_rfid_codes):
+    # Assigned locally right away; the journal keeps them until they reach Odoo
+    pending_owners = write_queue.journal.find_pending_owners(new_rfid_codes.values())
+    rfid_codes = {}
+    errors = {}
+    for person_id, rfid_code in new_rfid_codes.items():
+        # The same checks as a scanned card
+        other_owners = [other_key for other_key, other_handler in handlers.items()
+                        if other_key != table_key and other_handler.find_rfid_owner(rfid_code) is not None]
+        if other_owners:
+            errors[person_id] = "The card is already assigned to one of the {}".format(other_owners[0])
+        elif rfid_code in pending_owners:
+            errors[person_id] = "The card is already waiting to be written to another user"
+        else:
+            rfid_codes[person_id] = rfid_code
+    assigned, assign_errors = handlers[table_key].assign_rfid_codes(rfid_codes)
+    errors.update(assign_errors)
+    for person_id, error in errors.items():
+        logger.warning("RFID code '{}' not imported: {}".format(new_rfid_codes[person_id], error))
+    write_queue.put_many([(person.user_id, person.rfid_code, "") for person in assigned.values()])
+    return len(assigned)
+
+
+def start_task(window, task_runner, event_key, description, function, *args):
+    set_tab_enabled(window, task_tab_keys[event_key], False)
+    window['cancel_tasks'].update(disabled=False)
+    window['task_status'].update(description)
+    return task_runner.submit(event_key, description, function, *args)
+
+
+def finish_task(window, task_runner, task):
+    task_runner.finish(task)
+    set_tab_enabled(window, task_tab_keys[task.event_key], True)
+    if task.error:
+        sg.popup("{} failed: {}".format(task.description, task.error), title="Error")
+    if not task_runner.is_busy():
+        window['task_status'].update("")
+        window['task_progress'].update_bar(0, 1)
+        window['cancel_tasks'].update(disabled=True)
+
+
 if __name__ == "__main__":
     logger.info("Starting RFID Cards Manager")
+    # "summary" prints the time spent in Odoo calls, handler phases and rendering at exit; a path saves it as JSON
+    timings.dump_at_exit(os.environ.get("ULE_RFID_TIMINGS"))
 
     sg.theme('SystemDefault')
     window = sg.Window('ULE RFID Manager - Login', login_layout)
@@ -62,7 +254,8 @@ if __name__ == "__main__":
 
             odoo_connection_handler = OdooConnectionHandler()
             try:
-                odoo_connection = odoo_connection_handler.connect(url, db, username, password, self_signed)
+                odoo_connection_handler.connect(url, db, username, password, self_signed)
+                odoo_connection = odoo_connection_handler
                 is_logged = True
             except AttributeError:
                 window["error_message"].update("All login parameters must be set", visible=True)
@@ -74,81 +267,161 @@ if __name__ == "__main__":
                 window["error_message"].update(f"Connection to the server '{url}' could not be stablished", visible=True)
             except xmlrpc.client.Fault:
                 window["error_message"].update(f"Connection to the database '{db}' could not be stablished", visible=True)
+            except OSError as e:
+                window["error_message"].update(f"Connection to the server '{url}' failed: {e}", visible=True)
     
     window.close()
-    window = sg.Window('ULE RFID Manager', main_layout)
+    window = sg.Window('ULE RFID Manager', main_layout, finalize=True)
+    window['scan_input'].bind("<Return>", "_submit")
 
-    students_handler = StudentsHandler(odoo_connection)
-    teachers_handler = TeachersHandler(odoo_connection)
+    snapshot_store = SnapshotStore(odoo_connection.url, odoo_connection.db)
+    odoo_repository = OdooRepository(odoo_connection, snapshot_store)
+    students_handler = StudentsHandler(odoo_connection, odoo_repository)
+    teachers_handler = TeachersHandler(odoo_connection, odoo_repository)
+    task_runner = TaskRunner(window)
+    handlers = {"students": students_handler, "teachers": teachers_handler}
+    rfid_journal = RfidJournal(odoo_connection.url, odoo_connection.db)
+    rfid_write_queue = RfidWriteQueue(odoo_connection, rfid_journal, lambda outcome: window.write_event_value("rfid_writes_flushed", outcome))
+    rfid_write_queue.start()
+    if rfid_write_queue.pending_count():
+        window['scan_status'].update("Writing {} card(s) left from the last session".format(rfid_write_queue.pending_count()))
 
     course_names = course_names + students_handler.get_courses_names()
   
     while(True):
         event, values = window.read(100, timeout_key='timeout')
         if not are_students_loaded or not are_teachers_loaded:
-            students_handler.refresh_students()
+            # Show whatever the snapshot has and synchronize students and teachers with Odoo in parallel
             window['course_filter'].update(values=course_names)
-            window['students'].update(values=students_handler.build_list())
+            show_students(window, students_handler)
             window['course_filter'].update(set_to_index=0)
+            show_teachers(window, teachers_handler)
+            start_task(window, task_runner, "students_refreshed", "Loading students", students_handler.refresh_students, True)
+            start_task(window, task_runner, "teachers_refreshed", "Loading teachers", teachers_handler.refresh_teachers, True)
             are_students_loaded = True
-            teachers_handler.refresh_teachers()
-            window['teachers'].update(values=teachers_handler.build_list())
             are_teachers_loaded = True
+        if pending_searches:
+            apply_pending_searches(window)
         if event == 'timeout':
             continue
         elif event == sg.WIN_CLOSED:
+            if rfid_reader:
+                rfid_reader.stop()
+            rfid_write_queue.stop(RfidWriteQueue.CLOSE_TIMEOUT)
+            task_runner.shutdown()
             sys.exit()
+        elif event == TaskRunner.PROGRESS_EVENT:
+            task, done, total = values.get(event)
+            window['task_status'].update("{} ({}/{})".format(task.description, done, total))
+            window['task_progress'].update_bar(done, total)
+        elif event == "rfid_scanned":
+            assign_scanned_rfid(window, values, handlers, task_runner, rfid_write_queue, values.get(event))
+        elif event == "scan_input_submit":
+            window['scan_input'].update("")
+            rfid_code = normalize_rfid(values.get("scan_input"))
+            if rfid_code is None:
+                window['scan_status'].update("'{}' is not a valid RFID code".format(values.get("scan_input").strip()))
+            elif scan_debouncer.accept(rfid_code):
+                assign_scanned_rfid(window, values, handlers, task_runner, rfid_write_queue, rfid_code)
+        elif event == "connect_reader":
+            try:
+                toggle_rfid_reader(window, values.get("reader_device"))
+            except AttributeError as e:
+                sg.popup(e, title="Error")
+        elif event == "rfid_reader_failed":
+            window['connect_reader'].update("Connect")
+            sg.popup("The card reader stopped: {}".format(values.get(event)), title="Error")
+        elif event == "rfid_writes_flushed":
+            odoo_repository.invalidate("res.users")
+            report_flushed_writes(odoo_repository, values.get(event))
+        elif event == "cancel_tasks":
+            task_runner.cancel_all()
+            window['task_status'].update("Cancelling...")
+        elif event == "students_refreshed":
+            task = values.get(event)
+            finish_task(window, task_runner, task)
+            course_names = [default_course_filter] + students_handler.get_courses_names()
+            window['course_filter'].update(values=course_names)
+            window['course_filter'].update(set_to_index=0)
+            show_students(window, students_handler)
+        elif event == "teachers_refreshed":
+            task = values.get(event)
+            finish_task(window, task_runner, task)
+            show_teachers(window, teachers_handler)
+        elif event in ("students", "teachers"):
+            # A keyboard-wedge reader types into the focused element: a clicked row must not keep the focus
+            window['scan_input'].set_focus()
+        elif event in ("students_search", "students_sort", "students_sort_reverse", "students_previous_page", "students_next_page",
+                       "teachers_search", "teachers_sort", "teachers_sort_reverse", "teachers_previous_page", "teachers_next_page"):
+            handle_table_view_event(window, event, values)
         elif event == "course_filter" or event == "students_with_rfid":
             with_rfid = values.get("students_with_rfid")
             course_name = values.get("course_filter")
             course_name = "" if course_name == default_course_filter else course_name
             students_handler.filter(course_name, with_rfid)
-            window['students'].update(values=students_handler.build_list())
+            show_students(window, students_handler)
         elif event == "teachers_with_rfid":
             with_rfid = values.get("teachers_with_rfid")
             teachers_handler.filter(with_rfid)
-            window['teachers'].update(values=teachers_handler.build_list())
+            show_teachers(window, teachers_handler)
         elif event == "refresh_students":
             response = sg.popup_ok_cancel("Are you sure you want to refresh all students?", title="Refresh")
             if response == "OK":
-                students_handler.refresh_students()
-                window['course_filter'].update(set_to_index=0)
-                window['students'].update(values=students_handler.build_list())
+                odoo_repository.invalidate()
+                start_task(window, task_runner, "students_refreshed", "Refreshing students", students_handler.refresh_students, True)
+        elif event == "reload_students":
+            # Downloads everything again, for changes Odoo does not report through write_date
+            response = sg.popup_ok_cancel("Are you sure you want to download all students again?", title="Full reload")
+            if response == "OK":
+                odoo_repository.invalidate()
+                start_task(window, task_runner, "students_refreshed", "Reloading students", students_handler.refresh_students, False)
         elif event == "refresh_teachers":
             response = sg.popup_ok_cancel("Are you sure you want to refresh all teachers?", title="Refresh")
             if response == "OK":
-                teachers_handler.refresh_teachers()
-                window['teachers'].update(values=teachers_handler.build_list())
-        elif event == "export_students":
-            response = sg.popup_ok_cancel("Are you sure you want to export displayed students?", title="Export")
+                odoo_repository.invalidate()
+                start_task(window, task_runner, "teachers_refreshed", "Refreshing teachers", teachers_handler.refresh_teachers, True)
+        elif event == "reload_teachers":
+            response = sg.popup_ok_cancel("Are you sure you want to download all teachers again?", title="Full reload")
             if response == "OK":
-                students_handler.export_to_csv()
+                odoo_repository.invalidate()
+                start_task(window, task_runner, "teachers_refreshed", "Reloading teachers", teachers_handler.refresh_teachers, False)
+        elif event == "export_students":
+            file_path = sg.popup_get_file("Export displayed students to", save_as=True, default_extension=".csv", file_types=export_file_types)
+            if file_path:
+                try:
+                    students_handler.export(file_path)
+                except (AttributeError, OSError) as e:
+                    sg.popup(e, title="Error")
         elif event == "export_teachers":
-            response = sg.popup_ok_cancel("Are you sure you want to export displayed teachers?", title="Export")
-            if response == "OK":
-                teachers_handler.export_to_csv()
+            file_path = sg.popup_get_file("Export displayed teachers to", save_as=True, default_extension=".csv", file_types=export_file_types)
+            if file_path:
+                try:
+                    teachers_handler.export(file_path)
+                except (AttributeError, OSError) as e:
+                    sg.popup(e, title="Error")
         elif event == "import_students":
             file_path = sg.popup_get_file("CSV file to open")
             try:
-                new_rfid_codes = students_handler.import_csv(file_path)
-            except AttributeError as e:
+                import_report = students_handler.import_csv(file_path)
+            except (AttributeError, OSError) as e:
                 sg.popup(e, title="Error")
                 continue
-            response = sg.popup_ok_cancel("Are you sure you want to import {} new rfid code(s)?".format(len(new_rfid_codes.keys())), title="Import")
-            if response == "OK":
-                students_handler.write_rfid_codes(new_rfid_codes)
-                students_handler.refresh_students()
-                window['course_filter'].update(set_to_index=0)
-                window['students'].update(values=students_handler.build_list())
+            new_rfid_codes = import_report.new_rfid_codes
+            response = sg.popup_ok_cancel(import_report.summary(), "", "Are you sure you want to import {} new rfid code(s)?".format(len(new_rfid_codes.keys())), title="Import")
+            if response == "OK" and new_rfid_codes:
+                queued = queue_imported_rfid_codes(handlers, "students", rfid_write_queue, new_rfid_codes)
+                window['scan_status'].update("{} imported card(s) queued for writing".format(queued))
+                show_students(window, students_handler)
         elif event == "import_teachers":
             file_path = sg.popup_get_file("CSV file to open")
             try:
-                new_rfid_codes = teachers_handler.import_csv(file_path)
-            except AttributeError as e:
+                import_report = teachers_handler.import_csv(file_path)
+            except (AttributeError, OSError) as e:
                 sg.popup(e, title="Error")
                 continue
-            response = sg.popup_ok_cancel("Are you sure you want to import {} new rfid code(s)?".format(len(new_rfid_codes.keys())), title="Import")
-            if response == "OK":
-                teachers_handler.write_rfid_codes(new_rfid_codes)
-                teachers_handler.refresh_teachers()
-                window['teachers'].update(values=teachers_handler.build_list())
\ No newline at end of file
+            new_rfid_codes = import_report.new_rfid_codes
+            response = sg.popup_ok_cancel(import_report.summary(), "", "Are you sure you want to import {} new rfid code(s)?".format(len(new_rfid_codes.keys())), title="Import")
+            if response == "OK" and new_rfid_codes:
+                queued = queue_imported_rfid_codes(handlers, "teachers", rfid_write_queue, new_rfid_codes)
+                window['scan_status'].update("{} imported card(s) queued for writing".format(queued))
+                show_teachers(window, teachers_handler)
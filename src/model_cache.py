@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def from_odoo_list_to_dict(element_list):
+    if not isinstance(element_list, list):
+        return {}
+    return { element.get("id"): element for element in element_list}
+
+
+class ModelCache(object):
+    """Local copy of an Odoo model that can be kept up to date with write_date deltas.
+
+    Only ``fields`` are read, and only the records matching ``domain`` (a list, or a
+    callable returning one). Every refresh bumps ``revision``; consumers remember the
+    last revision they processed and ask ``changes_since`` which records changed or
+    disappeared.
+    """
+
+    WRITE_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+    # Before any write_date, for models without records
+    FIRST_SYNC = "1970-01-01 00:00:00"
+    # Odoo sets write_date when a transaction starts, so a record can be committed with a
+    # write_date older than records already read: deltas go back this far
+    LATE_COMMIT_MARGIN = datetime.timedelta(minutes=5)
+
+    def __init__(self, odoo_connection, model, fields, domain=None, snapshot_store=None):
+        self.odoo_connection = odoo_connection
+        self.model = model
+        # write_date is always read: the delta watermark comes from the server, not from the local clock
+        self.fields = list(fields) if "write_date" in fields else list(fields) + ["write_date"]
+        self.domain = domain
+        self.snapshot_store = snapshot_store
+        self.records = {}
+        self.last_sync = None
+        self.revision = 0
+        self.reset_revision = 0
+        self.record_revisions = {}
+        self.deleted_revisions = {}
+        self.stale_ids = set()
+        # Revision the snapshot store has, so only later changes need to be saved
+        self.snapshot_revision = None
+
+    def is_loaded(self):
+        return self.last_sync is not None
+
+    def require_fields(self, fields):
+        missing_fields = [field for field in fields if field not in self.fields]
+        if not missing_fields:
+            return
+        self.fields.extend(missing_fields)
+        # Records already loaded lack the new fields: the next refresh must read everything again
+        self.last_sync = None
+
+    def mark_stale(self, record_ids):
+        """Read the given records again on the next delta refresh, even if their write_date did not change."""
+        self.stale_ids.update(record_ids)
+
+    def get_domain(self):
+        domain = self.domain() if callable(self.domain) else self.domain
+        return list(domain or [])
+
+    def refresh(self, incremental=False):
+        if incremental and self.is_loaded():
+            self.__refresh_delta()
+        else:
+            self.__refresh_full()
+        self.__save_snapshot()
+        return self.revision
+
+    def __save_snapshot(self):
+        if not self.snapshot_store:
+            return
+        # Only what changed since the last save is written; without changes just last_sync is updated
+        changes = self.changes_since(self.snapshot_revision) if self.snapshot_revision is not None else None
+        saved = False
+        if changes is not None:
+            changed_ids, deleted_ids = changes
+            changed_records = [self.records[record_id] for record_id in changed_ids if record_id in self.records]
+            saved = self.snapshot_store.save_changes(self.model, changed_records, deleted_ids, self.fields, self.last_sync, len(self.records))
+        if not saved:
+            saved = self.snapshot_store.save(self.model, list(self.records.values()), self.fields, self.last_sync)
+        if saved:
+            self.snapshot_revision = self.revision
+
+    def load_snapshot(self):
+        """Fill the cache from the snapshot store. Return None if there is no usable snapshot, else whether it is still fresh."""
+        if not self.snapshot_store:
+            return None
+        snapshot = self.snapshot_store.load(self.model)
+        if not snapshot:
+            return None
+
+        odoo_records, fields, last_sync, saved_at = snapshot
+        if not set(self.fields).issubset(fields or []):
+            logger.info("Snapshot of '{}' does not have all the required fields".format(self.model))
+            return None
+        self.__reset(from_odoo_list_to_dict(odoo_records))
+        self.last_sync = last_sync
+        self.snapshot_revision = self.revision
+        logger.info("'{}' loaded from snapshot: {} record(s)".format(self.model, len(self.records)))
+        return not self.snapshot_store.is_stale(saved_at)
+
+    def __next_sync_mark(self, odoo_records, last_sync):
+        """Return the latest write_date of the records, or last_sync if none is later."""
+        return max([record.get("write_date") for record in odoo_records if record.get("write_date")] + [last_sync])
+
+    def __get_sync_start(self):
+        # Records fetched twice are simply overwritten
+        last_sync = datetime.datetime.strptime(self.last_sync, self.WRITE_DATE_FORMAT)
+        return (last_sync - self.LATE_COMMIT_MARGIN).strftime(self.WRITE_DATE_FORMAT)
+
+    def __reset(self, new_records):
+        self.revision += 1
+        self.reset_revision = self.revision
+        # Patched instead of cleared so other handlers reading the shared dict never see it empty
+        for record_id in set(self.records).difference(new_records):
+            del self.records[record_id]
+        self.records.update(new_records)
+        self.record_revisions = dict.fromkeys(self.records, self.revision)
+        self.deleted_revisions.clear()
+
+    def __add_records(self, odoo_records):
+        for record in odoo_records:
+            record_id = record.get("id")
+            self.records[record_id] = record
+            self.record_revisions[record_id] = self.revision
+            self.deleted_revisions.pop(record_id, None)
+
+    def __refresh_full(self):
+        self.stale_ids = set()
+        odoo_records = self.odoo_connection.search_read(self.model, self.get_domain(), self.fields)
+        self.__reset(from_odoo_list_to_dict(odoo_records))
+        self.last_sync = self.__next_sync_mark(odoo_records, self.FIRST_SYNC)
+        logger.info("'{}' fully loaded: {} record(s)".format(self.model, len(self.records)))
+
+    def __refresh_delta(self):
+        stale_ids = set(self.stale_ids)
+        domain = self.get_domain()
+        # Only the write dates at first: most records of the margin were already read by the last refresh
+        recent_records = self.odoo_connection.search_read(self.model, domain + [("write_date", ">=", self.__get_sync_start())], ["write_date"])
+        remote_ids = set(self.odoo_connection.search(self.model, domain))
+        changed_ids = {record.get("id") for record in recent_records
+                       if record.get("id") not in self.records or self.records[record.get("id")].get("write_date") != record.get("write_date")}
+        changed_ids |= remote_ids.difference(self.records).union(stale_ids.intersection(remote_ids))
+        changed_records = self.odoo_connection.read(self.model, sorted(changed_ids), self.fields) if changed_ids else []
+        deleted_ids = set(self.records).difference(remote_ids)
+
+        self.revision += 1
+        self.stale_ids.difference_update(stale_ids)
+        self.__add_records(changed_records)
+        for record_id in deleted_ids:
+            del self.records[record_id]
+            self.record_revisions.pop(record_id, None)
+            self.deleted_revisions[record_id] = self.revision
+        self.last_sync = self.__next_sync_mark(recent_records, self.last_sync)
+        logger.info("'{}' synchronized: {} changed, {} deleted".format(self.model, len(changed_records), len(deleted_ids)))
+
+    def ensure_ids(self, record_ids):
+        """Read the given records if they are not cached yet (e.g. users of students added since the last refresh)."""
+        if not self.is_loaded():
+            return
+        missing_ids = sorted(set(record_ids).difference(self.records))
+        if not missing_ids:
+            return
+        self.revision += 1
+        self.__add_records(self.odoo_connection.read(self.model, missing_ids, self.fields))
+        self.__save_snapshot()
+        logger.info("'{}': {} missing record(s) read".format(self.model, len(missing_ids)))
+
+    def changes_since(self, revision):
+        """Return (changed_ids, deleted_ids) after the given revision, or None if a full reload happened since."""
+        if revision < self.reset_revision:
+            return None
+        # Copied first: other handlers may be adding records from their worker threads
+        changed_ids = {record_id for record_id, record_revision in list(self.record_revisions.items()) if record_revision > revision}
+        deleted_ids = {record_id for record_id, record_revision in list(self.deleted_revisions.items()) if record_revision > revision}
+        return changed_ids, deleted_ids
@@ -1,19 +1,135 @@
 #!/usr/bin/env python3
 
+import collections
+import contextlib
+import http.client
 import logging
+import queue
+import ssl
+import threading
+import time
+from timing import span, timings
+import xmlrpc.client
 from odoo_ule_handler.odoo_handler import OdooHandler
 
 logger = logging.getLogger(__name__)
 
+CONNECTION_ERRORS = (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError)
+
+
+def split_in_chunks(elements, chunk_size):
+    for index in range(0, len(elements), chunk_size):
+        yield elements[index:index + chunk_size]
+
+
+class KeepAliveTransportMixin(object):
+    """Keeps the HTTP connection of the transport open between calls and applies a socket timeout."""
+
+    def __init__(self, timeout, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        # xmlrpc.client reuses the connection returned here while the server keeps it alive
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class KeepAliveTransport(KeepAliveTransportMixin, xmlrpc.client.Transport):
+    pass
+
+
+class KeepAliveSafeTransport(KeepAliveTransportMixin, xmlrpc.client.SafeTransport):
+    pass
+
+
+class ServerProxyPool(object):
+    """A few keep-alive proxies shared by every thread.
+
+    xmlrpc.client.ServerProxy is not thread safe, so each call checks one out. At most
+    ``size`` calls run in parallel, and a proxy whose connection failed is closed instead
+    of being reused, so a broken connection is never handed out again.
+    """
+
+    def __init__(self, create_proxy, size):
+        self.create_proxy = create_proxy
+        self.idle_proxies = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def proxy(self):
+        with self.slots:
+            try:
+                proxy = self.idle_proxies.get_nowait()
+            except queue.Empty:
+                proxy = self.create_proxy()
+            broken = True
+            try:
+                yield proxy
+                broken = False
+            except xmlrpc.client.Fault:
+                # The server answered: the connection is fine
+                broken = False
+                raise
+            finally:
+                if broken:
+                    proxy("close")()
+                else:
+                    self.idle_proxies.put(proxy)
+
+    def close(self):
+        while True:
+            try:
+                self.idle_proxies.get_nowait()("close")()
+            except queue.Empty:
+                return
+
 
 class OdooConnectionHandler(object):
-    def __init__(self, url="", db="", username="", password="", self_signed=False):
+    """Odoo XML-RPC calls over a pool of keep-alive connections.
+
+    Calls that can be repeated safely are retried with exponential backoff when the
+    connection fails, and every call is retried once after authenticating again if
+    Odoo denies access. Each call is timed in the ``odoo.<model>.<method>`` span, its failed
+    attempts in ``odoo.<model>.<method>.failed`` and its waits before retrying in
+    ``odoo.<model>.<method>.retry_wait``.
+    """
+
+    USERS_MODEL = "res.users"
+    RFID_FIELD = OdooHandler.RFID_VAR
+    DEFAULT_WRITE_CHUNK_SIZE = 100
+    DEFAULT_TIMEOUT = 120 # seconds
+    DEFAULT_RETRIES = 3
+    DEFAULT_RETRY_DELAY = 0.5 # seconds, doubled on every retry
+    DEFAULT_POOL_SIZE = 4
+    # write only sets field values, so repeating it after a lost response is harmless
+    IDEMPOTENT_METHODS = ("search", "search_read", "search_count", "read", "fields_get", "write")
+    ACCESS_DENIED_FAULTS = ("AccessDenied", "Access Denied", "Session expired")
+
+    def __init__(self, url="", db="", username="", password="", self_signed=False, write_chunk_size=DEFAULT_WRITE_CHUNK_SIZE,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY, pool_size=DEFAULT_POOL_SIZE):
         self.url = url
         self.db = db
         self.username = username
         self.password = password
         self.self_signed = self_signed
+        self.write_chunk_size = write_chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool_size = pool_size
         self.connection = None
+        self.pool = None
+        self.authentication_lock = threading.Lock()
+        self.unreachable_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Everything not implemented here (get_all_users, get_all_students...) is served by the OdooHandler
+        connection = self.__dict__.get("connection")
+        if connection is None:
+            raise AttributeError(name)
+        return getattr(connection, name)
 
     def connect(self, url=None, db=None, username=None, password=None, self_signed=False):
         url_ = url if url else self.url
@@ -22,12 +138,196 @@ class OdooConnectionHandler(object):
         password_ = password if password else self.password
         self_signed_ = self_signed if self_signed else self.self_signed
 
-        self.connection = OdooHandler(url_, self_signed_)
+        connection = OdooHandler(url_, self_signed_)
+        # The OdooHandler proxies are replaced by ones with keep-alive and timeout
+        connection.common = self.__create_proxy(url_, self_signed_, "common")
+        connection.models = self.__create_proxy(url_, self_signed_, "object")
+        connection.connect(db_, username_, password_)
 
+        if self.pool:
+            self.pool.close()
+        self.connection = connection
+        self.pool = ServerProxyPool(lambda: self.__create_proxy(url_, self_signed_, "object"), self.pool_size)
+        self.url, self.db, self.username, self.password, self.self_signed = url_, db_, username_, password_, self_signed_
+        return self.connection
+
+    def __create_proxy(self, url, self_signed, endpoint):
+        if url.startswith("https"):
+            context = ssl._create_unverified_context() if self_signed else None
+            transport = KeepAliveSafeTransport(self.timeout, context=context)
+        else:
+            transport = KeepAliveTransport(self.timeout)
+        return xmlrpc.client.ServerProxy("{}/xmlrpc/2/{}".format(url, endpoint), transport=transport)
+
+    def __record_failure(self, name, started_at):
+        timings.record("odoo.{}.failed".format(name), time.perf_counter() - started_at)
+
+    def __is_access_denied(self, fault):
+        return any(text in str(fault.faultString) for text in self.ACCESS_DENIED_FAULTS)
+
+    def __is_retryable(self, error):
+        if isinstance(error, xmlrpc.client.ProtocolError):
+            # Only server side and throttling errors can go away by themselves
+            return error.errcode >= 500 or error.errcode == 429
+        return True
+
+    def __reauthenticate(self, connection):
+        with self.authentication_lock:
+            if connection is not self.connection:
+                return
+            logger.info("Odoo denied access, authenticating '{}' again".format(self.username))
+            uid = connection.common.authenticate(self.db, self.username, self.password, {})
+            if not uid:
+                raise ConnectionRefusedError("User could not be authenticated")
+            connection.uid = uid
+
+    def call(self, name, function, idempotent=True):
+        """Run ``function(proxy, connection)`` with a pooled proxy, retrying it as the class documents."""
+        with span("odoo." + name):
+            return self.__call(name, function, idempotent)
+
+    def __call(self, name, function, idempotent):
+        retries = self.retries if idempotent else 0
+        attempt = 0
+        reauthenticated = False
+        while True:
+            connection = self.connection
+            started_at = time.perf_counter()
+            try:
+                with self.pool.proxy() as proxy:
+                    result = function(proxy, connection)
+            except xmlrpc.client.Fault as e:
+                self.__record_failure(name, started_at)
+                if reauthenticated or not self.__is_access_denied(e):
+                    raise
+                self.__reauthenticate(connection)
+                reauthenticated = True
+                continue
+            except CONNECTION_ERRORS as e:
+                self.__record_failure(name, started_at)
+                if attempt >= retries or not self.__is_retryable(e):
+                    raise
+                delay = self.retry_delay * 2 ** attempt
+                attempt += 1
+                logger.warning("{} failed: '{}'. Retrying in {:.1f}s ({}/{})".format(name, e, delay, attempt, retries))
+                with span("odoo.{}.retry_wait".format(name)):
+                    time.sleep(delay)
+                continue
+            return result
+
+    def execute_kw(self, model, method, args, kwargs=None):
+        def execute(proxy, connection):
+            return proxy.execute_kw(connection.db, connection.uid, connection.password, model, method, args, kwargs or {})
+        return self.call("{}.{}".format(model, method), execute, method in self.IDEMPOTENT_METHODS)
+
+    def search(self, model, domain):
+        return self.execute_kw(model, "search", [domain])
+
+    def search_read(self, model, domain, fields=None):
+        kwargs = {"fields": fields} if fields else {}
+        return self.execute_kw(model, "search_read", [domain], kwargs)
+
+    def read(self, model, ids, fields=None):
+        kwargs = {"fields": fields} if fields else {}
+        return self.execute_kw(model, "read", [ids], kwargs)
+
+    def write_users_rfid(self, rfid_codes, chunk_size=None, progress=None):
+        """Write {user_id: rfid_code} to Odoo and return {user_id: True/False} with the result of each user.
+
+        ``progress(written, total)`` is called after every chunk. Once a write can not reach
+        Odoo, the users that are left are not tried and fail.
+        """
+        chunk_size = chunk_size or self.write_chunk_size
+        results = {}
+        unreachable = threading.Event()
+        user_ids_by_rfid = collections.defaultdict(list)
+        for user_id, rfid_code in rfid_codes.items():
+            user_ids_by_rfid[rfid_code].append(user_id)
+
+        single_writes = []
+        for rfid_code, user_ids in user_ids_by_rfid.items():
+            if len(user_ids) == 1:
+                single_writes.append((user_ids[0], rfid_code))
+                continue
+            # Users sharing the same value (e.g. cleared cards) are written with a single call
+            for user_ids_chunk in split_in_chunks(user_ids, chunk_size):
+                if not unreachable.is_set() and self.__write_users(user_ids_chunk, rfid_code, unreachable):
+                    results.update({user_id: True for user_id in user_ids_chunk})
+                    if progress:
+                        progress(len(results), len(rfid_codes))
+                else:
+                    single_writes.extend((user_id, rfid_code) for user_id in user_ids_chunk)
+
+        for writes_chunk in split_in_chunks(single_writes, chunk_size):
+            if unreachable.is_set():
+                results.update({user_id: False for user_id, _ in writes_chunk})
+            else:
+                results.update(self.__write_chunk(writes_chunk, unreachable))
+            if progress:
+                progress(len(results), len(rfid_codes))
+
+        failed = [user_id for user_id, success in results.items() if not success]
+        if failed:
+            logger.error("RFID code could not be written for {} user(s): {}".format(len(failed), failed))
+        return results
+
+    def __set_unreachable(self, unreachable, error):
+        # Writing the other users would only wait for the same unreachable server
+        with self.unreachable_lock:
+            if unreachable.is_set():
+                return
+            unreachable.set()
+        logger.error("Odoo could not be reached, the remaining RFID codes are not written: '{}'".format(error))
+
+    def __write_users(self, user_ids, rfid_code, unreachable):
         try:
-            self.connection.connect(db_, username_, password_)
-        except:
-            raise
+            return bool(self.execute_kw(self.USERS_MODEL, "write", [user_ids, {self.RFID_FIELD: rfid_code}]))
+        except CONNECTION_ERRORS as e:
+            self.__set_unreachable(unreachable, e)
+            return False
+        except xmlrpc.client.Error as e:
+            logger.error("Error writing RFID code to users {}: '{}'".format(user_ids, e))
+            return False
 
-        return self.connection
+    def __write_chunk(self, writes, unreachable):
+        # The object endpoint of Odoo has no system.multicall: the writes run in parallel over the connection pool
+        def write(user_id, rfid_code):
+            if unreachable.is_set():
+                return False
+            try:
+                return bool(self.execute_kw(self.USERS_MODEL, "write", [[user_id], {self.RFID_FIELD: rfid_code}]))
+            except CONNECTION_ERRORS as e:
+                self.__set_unreachable(unreachable, e)
+                return False
+            except xmlrpc.client.Error as e:
+                logger.error("Error writing RFID code to user '{}': '{}'".format(user_id, e))
+                return False
+
+        pending = queue.Queue()
+        for user_id, rfid_code in writes:
+            pending.put((user_id, rfid_code))
+        results = {}
+        errors = []
+
+        def work():
+            while True:
+                try:
+                    user_id, rfid_code = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[user_id] = write(user_id, rfid_code)
+                except Exception as e:
+                    errors.append(e)
+                    return
 
+        # Daemon threads instead of a ThreadPoolExecutor, which joins its workers at exit
+        # and would keep the program open until a write to an unresponsive Odoo times out
+        workers = [threading.Thread(target=work, name="odoo-write", daemon=True) for _ in range(min(self.pool_size, len(writes)))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+        return {user_id: results.get(user_id, False) for user_id, _ in writes}
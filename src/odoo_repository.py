@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+from model_cache import ModelCache
+
+logger = logging.getLogger(__name__)
+
+
+class OdooRepository(object):
+    """Model caches shared by all the handlers of one Odoo connection.
+
+    A model refreshed less than ``ttl`` seconds ago is not fetched again unless it
+    has been invalidated, and concurrent refreshes of the same model wait for the
+    one in progress instead of downloading it twice.
+    """
+
+    DEFAULT_TTL = 30 # seconds
+
+    USERS_MODEL = "res.users"
+    # Models whose records point to a user through "user_id". Only those users are downloaded.
+    USER_OWNER_MODELS = ("op.student", "op.faculty")
+
+    def __init__(self, odoo_connection, snapshot_store=None, ttl=DEFAULT_TTL):
+        self.odoo_connection = odoo_connection
+        self.snapshot_store = snapshot_store
+        self.ttl = ttl
+        self.caches = {}
+        self.refreshed_at = {}
+        self.snapshots_freshness = {}
+        self.__lock = threading.Lock()
+        self.__model_locks = {}
+
+    def __get_model_lock(self, model):
+        with self.__lock:
+            return self.__model_locks.setdefault(model, threading.Lock())
+
+    def get_cache(self, model, fields=()):
+        """Return the shared cache of the model, making sure it reads at least the given fields."""
+        with self.__lock:
+            cache = self.caches.get(model)
+            if not cache:
+                domain = self.__get_linked_users_domain if model == self.USERS_MODEL else None
+                cache = ModelCache(self.odoo_connection, model, fields, domain, self.snapshot_store)
+                self.caches[model] = cache
+            else:
+                cache.require_fields(fields)
+            return cache
+
+    def __get_linked_user_ids(self):
+        user_ids = set()
+        for model in self.USER_OWNER_MODELS:
+            cache = self.caches.get(model)
+            if not cache:
+                continue
+            for record in list(cache.records.values()):
+                user = record.get("user_id")
+                if user:
+                    user_ids.add(user[0])
+        return user_ids
+
+    def __get_linked_users_domain(self):
+        return [("id", "in", sorted(self.__get_linked_user_ids()))]
+
+    def load_snapshot(self, model):
+        """Load the model from the snapshot store once. Return None if there is no snapshot, else whether it is fresh."""
+        cache = self.get_cache(model)
+        with self.__get_model_lock(model):
+            if model not in self.snapshots_freshness:
+                # Already synchronized with Odoo by another handler: as good as a fresh snapshot
+                self.snapshots_freshness[model] = True if cache.is_loaded() else cache.load_snapshot()
+            return self.snapshots_freshness[model]
+
+    def refresh(self, model, incremental=False):
+        cache = self.get_cache(model)
+        requested_at = time.monotonic()
+        with self.__get_model_lock(model):
+            refreshed_at = self.refreshed_at.get(model)
+            if refreshed_at is not None:
+                if refreshed_at >= requested_at:
+                    logger.debug("'{}' was refreshed while waiting for it".format(model))
+                    return cache.revision
+                if time.monotonic() - refreshed_at < self.ttl:
+                    logger.debug("'{}' is still valid".format(model))
+                    return cache.revision
+            cache.refresh(incremental)
+            self.refreshed_at[model] = time.monotonic()
+        if model in self.USER_OWNER_MODELS and self.USERS_MODEL in self.caches:
+            # New students or teachers may point to users that the users cache did not need until now
+            with self.__get_model_lock(self.USERS_MODEL):
+                self.caches[self.USERS_MODEL].ensure_ids(self.__get_linked_user_ids())
+        return cache.revision
+
+    def mark_stale(self, model, record_ids):
+        """Make the next refresh of the model read the given records again."""
+        self.get_cache(model).mark_stale(record_ids)
+        self.invalidate(model)
+
+    def invalidate(self, model=None):
+        with self.__lock:
+            if model:
+                self.refreshed_at.pop(model, None)
+            else:
+                self.refreshed_at.clear()
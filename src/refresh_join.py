@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import gc
+import logging
+from student import Student, course_table
+from teacher import Teacher
+
+logger = logging.getLogger(__name__)
+
+NO_COURSES = frozenset()
+
+
+@contextlib.contextmanager
+def paused_gc():
+    """Pause the cyclic garbage collector while a refresh allocates one object per record.
+
+    The new objects hold no reference cycles, but every few hundred allocations the collector
+    would scan all the cached records again, which took most of the time of a large join.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+
+class OrphanReport(object):
+    """Records whose links could not be followed, logged once per reason instead of once per record."""
+
+    SAMPLE_SIZE = 10
+
+    def __init__(self, model):
+        self.model = model
+        self.orphans = collections.OrderedDict()
+
+    def add(self, reason, record_id):
+        self.orphans.setdefault(reason, []).append(record_id)
+
+    def log(self):
+        for reason, record_ids in self.orphans.items():
+            sample = ", ".join(str(record_id) for record_id in record_ids[:self.SAMPLE_SIZE])
+            logger.error("{} '{}' record(s) {}: {}{}".format(len(record_ids), self.model, reason, sample,
+                                                            "..." if len(record_ids) > self.SAMPLE_SIZE else ""))
+
+
+def get_enrollment_courses(enrollments, courses):
+    """Return {enrollment_id: course_id} and update the course names.
+
+    Names come from op.course, because renaming a course does not change the write_date
+    of its enrollments. Only courses that are not loaded keep the enrollment's name.
+    """
+    course_ids_by_enrollment = {}
+    names = {}
+    for enrollment_id, enrollment in enrollments.items():
+        course = enrollment.get("course_id")
+        if course:
+            course_ids_by_enrollment[enrollment_id] = course[0]
+            names[course[0]] = course[1]
+    names.update((course_id, course.get("display_name")) for course_id, course in courses.items())
+    course_table.set_names(names)
+    return course_ids_by_enrollment
+
+
+def join_students(odoo_students, course_ids_by_enrollment, users, rfid_field, previous=None):
+    """Return [(student_id, Student)] joining op.student records with their user and enrollments.
+
+    Everything is looked up in a single pass over the records without a call per student.
+    Students equal to the ones in ``previous`` are reused, so a full reload only allocates
+    the ones that changed. Students whose user is missing are left out.
+    """
+    orphans = OrphanReport("op.student")
+    get_user = users.get
+    get_course_id = course_ids_by_enrollment.get
+    get_previous = (previous or {}).get
+    students = []
+    for odoo_student in odoo_students:
+        student_id = odoo_student["id"]
+        user_link = odoo_student.get("user_id")
+        user = get_user(user_link[0]) if user_link else None
+        if user is None:
+            orphans.add("without a loaded user", student_id)
+            continue
+        course_detail_ids = odoo_student.get("course_detail_ids")
+        if course_detail_ids:
+            course_ids = frozenset(map(get_course_id, course_detail_ids))
+            if None in course_ids:
+                orphans.add("with enrollments that are not loaded", student_id)
+                course_ids = course_ids.difference((None,))
+        else:
+            course_ids = NO_COURSES
+        user_id = user_link[0]
+        name = odoo_student.get("display_name")
+        identification_code = odoo_student.get("identification_code") or ""
+        student_code = str(odoo_student.get("gr_no") or "")
+        rfid_code = user.get(rfid_field) or ""
+
+        student = get_previous(student_id)
+        if (student is None or student.rfid_code != rfid_code or student.name != name or student.user_id != user_id
+                or student.identification_code != identification_code or student.student_code != student_code or student.course_ids != course_ids):
+            student = Student(student_id, user_id, name, identification_code, student_code, course_ids, rfid_code)
+        students.append((student_id, student))
+    orphans.log()
+    return students
+
+
+def join_teachers(odoo_teachers, users, rfid_field, previous=None):
+    """Return [(teacher_id, Teacher)] joining op.faculty records with their user, like join_students."""
+    orphans = OrphanReport("op.faculty")
+    get_user = users.get
+    get_previous = (previous or {}).get
+    teachers = []
+    for odoo_teacher in odoo_teachers:
+        teacher_id = odoo_teacher["id"]
+        user_link = odoo_teacher.get("user_id")
+        user = get_user(user_link[0]) if user_link else None
+        if user is None:
+            orphans.add("without a loaded user", teacher_id)
+            continue
+        user_id = user_link[0]
+        name = odoo_teacher.get("display_name")
+        identification_code = odoo_teacher.get("identification_code") or ""
+        rfid_code = user.get(rfid_field) or ""
+
+        teacher = get_previous(teacher_id)
+        if (teacher is None or teacher.rfid_code != rfid_code or teacher.name != name or teacher.user_id != user_id
+                or teacher.identification_code != identification_code):
+            teacher = Teacher(teacher_id, user_id, name, identification_code, rfid_code)
+        teachers.append((teacher_id, teacher))
+    orphans.log()
+    return teachers
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+from csv_importer import RFID_PATTERN, read_csv_rows
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class DiffReport(object):
+    """RFID differences between a source (a CSV file or another database) and the local people.
+
+    Every source row ends in exactly one set: added (the person has no card), changed
+    (the person has another card), conflicting (the card belongs to someone else),
+    orphaned (no such person), unchanged, or invalid.
+    """
+
+    KINDS = ("added", "changed", "conflicting", "orphaned", "unchanged")
+    APPLICABLE_KINDS = ("added", "changed")
+
+    def __init__(self, source=""):
+        self.source = source
+        self.added = []
+        self.changed = []
+        self.conflicting = []
+        self.orphaned = []
+        self.unchanged = []
+        self.invalid = []
+        self.without_rfid = 0
+
+    def select(self, kinds=APPLICABLE_KINDS, person_ids=None):
+        """Return {person_id: rfid_code} with the changes of the given kinds, optionally only for some people."""
+        selected = {}
+        for kind in kinds:
+            if kind not in self.APPLICABLE_KINDS:
+                raise AttributeError("Only {} changes can be applied".format(" and ".join(self.APPLICABLE_KINDS)))
+            for entry in getattr(self, kind):
+                if person_ids is None or entry["id"] in person_ids:
+                    selected[entry["id"]] = entry["rfid"]
+        return selected
+
+    def summary(self):
+        return ("{} card(s) to add\n"
+                "{} card(s) to change\n"
+                "{} conflicting card(s)\n"
+                "{} row(s) of unknown people\n"
+                "{} unchanged card(s)\n"
+                "{} invalid row(s)\n"
+                "{} row(s) without RFID").format(len(self.added), len(self.changed), len(self.conflicting), len(self.orphaned),
+                                                  len(self.unchanged), len(self.invalid), self.without_rfid)
+
+    def to_dict(self):
+        result = {"source": self.source}
+        result.update({kind: getattr(self, kind) for kind in self.KINDS})
+        result["invalid"] = self.invalid
+        result["without_rfid"] = self.without_rfid
+        return result
+
+
+def csv_source_rows(file_path, columns):
+    """Yield (line_number, row) for diff_rfid_codes. Rows with a wrong number of columns are None."""
+    for line_number, values in read_csv_rows(file_path, columns):
+        if len(values) != len(columns):
+            yield line_number, None
+            continue
+        yield line_number, {column: value.strip() for column, value in zip(columns, values)}
+
+
+def people_source_rows(people, export_columns):
+    """Yield (person_id, row) for diff_rfid_codes, with the people of another handler exported as CSV rows."""
+    for person_id, person in people.items():
+        yield person_id, {column: getter(person) or "" for column, getter in export_columns.items()}
+
+
+def diff_rfid_codes(source_rows, find_person, get_person_rfid, find_rfid_owner, source="", rfid_column="RFID"):
+    """Compare the (origin, row) pairs of a source with the local people in a single pass.
+
+    The callbacks are the ones of import_rfid_codes and are expected to be index lookups,
+    so a source of any size is joined in linear time.
+    """
+    report = DiffReport(source)
+    source_owners = {}
+    source_people = set()
+    for origin, row in source_rows:
+        if row is None:
+            report.invalid.append({"source": origin, "reason": "wrong number of columns"})
+            continue
+        person_id = find_person(row)
+        if person_id is None:
+            report.orphaned.append({"source": origin, "row": row})
+            continue
+        rfid_code = row.get(rfid_column)
+        if not rfid_code:
+            report.without_rfid += 1
+            continue
+        if not RFID_PATTERN.match(rfid_code):
+            report.invalid.append({"source": origin, "reason": "invalid RFID code '{}'".format(rfid_code)})
+            continue
+
+        current_rfid_code = get_person_rfid(person_id) or ""
+        entry = {"source": origin, "id": person_id, "rfid": rfid_code, "current_rfid": current_rfid_code}
+        if person_id in source_people:
+            entry["reason"] = "the person appears more than once"
+            report.conflicting.append(entry)
+            continue
+        source_people.add(person_id)
+        # The first source row that claims a card wins it
+        owner_id = source_owners.setdefault(rfid_code, person_id)
+        if current_rfid_code == rfid_code:
+            report.unchanged.append(entry)
+            continue
+        if owner_id == person_id:
+            owner_id = find_rfid_owner(rfid_code)
+        if owner_id is not None and owner_id != person_id:
+            entry["owner"] = owner_id
+            entry["reason"] = "the card belongs to someone else"
+            report.conflicting.append(entry)
+        elif current_rfid_code:
+            report.changed.append(entry)
+        else:
+            report.added.append(entry)
+
+    logger.info("Diff with '{}': {} added, {} changed, {} conflicting, {} orphaned, {} unchanged".format(
+        source, len(report.added), len(report.changed), len(report.conflicting), len(report.orphaned), len(report.unchanged)))
+    return report
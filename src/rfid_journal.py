@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+JournalEntry = collections.namedtuple("JournalEntry", ["entry_id", "user_id", "rfid_code", "previous_rfid", "attempts"])
+
+
+class RfidJournal(object):
+    """RFID assignments saved in a local SQLite file before they are sent to Odoo.
+
+    Every assignment starts as pending and ends as written, conflict (Odoo already had
+    another value) or failed (Odoo rejected it too many times). Pending assignments
+    survive a crash or restart and are sent by the next RfidWriteQueue.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".ule-rfid-manager", "journal.sqlite3")
+    KEEP_FINISHED = 30 * 24 * 60 * 60 # seconds
+
+    PENDING = "pending"
+    WRITTEN = "written"
+    CONFLICT = "conflict"
+    FAILED = "failed"
+    SUPERSEDED = "superseded"
+
+    def __init__(self, url, db, path=DEFAULT_PATH):
+        self.url = url
+        self.db = db
+        self.path = path
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.__connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS assignments ("
+                               "entry_id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, db TEXT NOT NULL, "
+                               "user_id INTEGER NOT NULL, rfid_code TEXT NOT NULL, previous_rfid TEXT NOT NULL, "
+                               "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, reason TEXT, "
+                               "created_at REAL NOT NULL, updated_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS assignments_status ON assignments (url, db, status)")
+            connection.execute("CREATE INDEX IF NOT EXISTS assignments_user ON assignments (url, db, user_id, status)")
+            connection.execute("DELETE FROM assignments WHERE url = ? AND db = ? AND status != ? AND updated_at < ?",
+                               (self.url, self.db, self.PENDING, time.time() - self.KEEP_FINISHED))
+
+    def __connect(self):
+        # A new connection per operation so the journal can be used from background threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, assignments):
+        """Record [(user_id, rfid_code, previous_rfid)] as pending, replacing pending assignments of the same users.
+
+        Only the last assignment of a user in the list is recorded.
+        """
+        now = time.time()
+        latest = collections.OrderedDict()
+        for user_id, rfid_code, previous_rfid in assignments:
+            # The value Odoo is expected to have is still the one of the first assignment that was not sent
+            previous_rfid = latest[user_id][1] if user_id in latest else previous_rfid
+            latest.pop(user_id, None)
+            latest[user_id] = (rfid_code, previous_rfid or "")
+        if not latest:
+            return
+        with self.__connect() as connection:
+            rows = connection.execute("SELECT user_id, previous_rfid FROM assignments WHERE url = ? AND db = ? AND status = ? ORDER BY entry_id DESC",
+                                      (self.url, self.db, self.PENDING)).fetchall()
+            # Descending, so the oldest pending assignment of every user is the one kept
+            pending_previous = {user_id: previous_rfid for user_id, previous_rfid in rows if user_id in latest}
+            connection.executemany("UPDATE assignments SET status = ?, reason = NULL, updated_at = ? WHERE url = ? AND db = ? AND user_id = ? AND status = ?",
+                                   [(self.SUPERSEDED, now, self.url, self.db, user_id, self.PENDING) for user_id in pending_previous])
+            connection.executemany("INSERT INTO assignments (url, db, user_id, rfid_code, previous_rfid, status, created_at, updated_at) "
+                                   "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   [(self.url, self.db, user_id, rfid_code, pending_previous.get(user_id, previous_rfid), self.PENDING, now, now)
+                                    for user_id, (rfid_code, previous_rfid) in latest.items()])
+
+    def __set_status(self, connection, status, condition, parameters, now, reason=None):
+        connection.execute("UPDATE assignments SET status = ?, reason = ?, updated_at = ? WHERE url = ? AND db = ? AND " + condition,
+                           (status, reason, now, self.url, self.db) + tuple(parameters))
+
+    def get_pending(self, limit):
+        with self.__connect() as connection:
+            rows = connection.execute("SELECT entry_id, user_id, rfid_code, previous_rfid, attempts FROM assignments "
+                                      "WHERE url = ? AND db = ? AND status = ? ORDER BY entry_id LIMIT ?",
+                                      (self.url, self.db, self.PENDING, limit)).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def count(self, status=PENDING):
+        with self.__connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM assignments WHERE url = ? AND db = ? AND status = ?",
+                                      (self.url, self.db, status)).fetchone()[0]
+
+    def find_pending_owner(self, rfid_code):
+        """Return the user that is waiting to receive the card, or None."""
+        with self.__connect() as connection:
+            row = connection.execute("SELECT user_id FROM assignments WHERE url = ? AND db = ? AND status = ? AND rfid_code = ? LIMIT 1",
+                                     (self.url, self.db, self.PENDING, rfid_code)).fetchone()
+        return row[0] if row else None
+
+    def find_pending_owners(self, rfid_codes):
+        """Return {rfid_code: user_id} of the cards that are waiting to be written, like find_pending_owner."""
+        rfid_codes = set(rfid_codes)
+        with self.__connect() as connection:
+            rows = connection.execute("SELECT rfid_code, user_id FROM assignments WHERE url = ? AND db = ? AND status = ?",
+                                      (self.url, self.db, self.PENDING)).fetchall()
+        return {rfid_code: user_id for rfid_code, user_id in rows if rfid_code in rfid_codes}
+
+    def mark_written(self, entries):
+        now = time.time()
+        with self.__connect() as connection:
+            for entry in entries:
+                self.__set_status(connection, self.WRITTEN, "entry_id = ?", (entry.entry_id,), now)
+                # A newer assignment of the same user now expects the value just written
+                connection.execute("UPDATE assignments SET previous_rfid = ? WHERE url = ? AND db = ? AND user_id = ? AND status = ? AND entry_id > ?",
+                                   (entry.rfid_code, self.url, self.db, entry.user_id, self.PENDING, entry.entry_id))
+
+    def mark_conflict(self, entry, reason):
+        with self.__connect() as connection:
+            self.__set_status(connection, self.CONFLICT, "entry_id = ?", (entry.entry_id,), time.time(), reason)
+
+    def mark_attempt_failed(self, entries, max_attempts):
+        """Count a failed write. Return the entries that will not be tried again."""
+        now = time.time()
+        failed = []
+        with self.__connect() as connection:
+            for entry in entries:
+                connection.execute("UPDATE assignments SET attempts = attempts + 1, updated_at = ? WHERE entry_id = ?", (now, entry.entry_id))
+                if entry.attempts + 1 >= max_attempts:
+                    self.__set_status(connection, self.FAILED, "entry_id = ?", (entry.entry_id,), now, "Odoo rejected the write")
+                    failed.append(entry)
+        return failed
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+from csv_importer import RFID_PATTERN
+import logging
+import os
+import select
+import stat
+import threading
+import time
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEBOUNCE = 1.5 # seconds during which repeated reads of the same card are ignored
+DEFAULT_BAUD_RATE = 9600
+POLL_INTERVAL = 0.2
+
+
+def normalize_rfid(raw_code):
+    """Return the card code of one reader line, or None if it is not a valid RFID code."""
+    rfid_code = raw_code.strip()
+    if not RFID_PATTERN.match(rfid_code):
+        return None
+    return rfid_code
+
+
+class RfidDebouncer(object):
+    """Drops the repeated reads that a reader sends while a card stays close to it."""
+
+    def __init__(self, interval=DEFAULT_DEBOUNCE):
+        self.interval = interval
+        self.last_reads = {}
+        self.lock = threading.Lock()
+
+    def accept(self, rfid_code, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last_read = self.last_reads.get(rfid_code)
+            self.last_reads[rfid_code] = now
+            if len(self.last_reads) > 1000:
+                self.last_reads = {code: read_at for code, read_at in self.last_reads.items() if now - read_at < self.interval}
+            return last_read is None or now - last_read >= self.interval
+
+
+class RfidReader(object):
+    """Reads card codes from a serial reader, a named pipe or a pty in a background thread.
+
+    Each line of the stream is one card. Valid codes that pass the debouncer are handed
+    to ``on_scan`` from the reader thread, and ``on_error`` is called if the stream fails.
+    Serial ports are opened with pyserial, which also takes port names such as COM3 that
+    are not files. Without pyserial the device is read as it is, so it must be set up with
+    stty. Pipes and ptys can only be read on POSIX systems.
+    """
+
+    def __init__(self, device_path, on_scan, on_error=None, debouncer=None, baud_rate=DEFAULT_BAUD_RATE):
+        self.device_path = device_path
+        self.on_scan = on_scan
+        self.on_error = on_error
+        self.debouncer = debouncer or RfidDebouncer()
+        self.baud_rate = baud_rate
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None
+        self.serial_port = False
+
+    def start(self):
+        if not self.device_path:
+            raise AttributeError("The card reader device must be set")
+        self.serial_port = self.__is_serial_port()
+        if not self.serial_port:
+            # Pipes and ptys are read with O_NONBLOCK and select() on the file, which only works on POSIX
+            if os.name != "posix":
+                raise AttributeError("The card reader device '{}' must be a serial port{}".format(
+                    self.device_path, "" if serial else " and pyserial must be installed"))
+            if not os.path.exists(self.device_path):
+                raise AttributeError("The card reader device '{}' does not exist".format(self.device_path))
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__run, name="rfid-reader", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(POLL_INTERVAL * 5)
+        self.thread = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def __is_serial_port(self):
+        if serial is None:
+            return False
+        if not os.path.exists(self.device_path):
+            # Port names such as COM3 are not files: pyserial opens them as they are
+            return os.name != "posix"
+        # Pipes and plain files are always read directly
+        return stat.S_ISCHR(os.stat(self.device_path).st_mode)
+
+    def __read_serial_chunks(self):
+        with serial.Serial(self.device_path, self.baud_rate, timeout=POLL_INTERVAL) as port:
+            while not self.stopped.is_set():
+                yield port.read(port.in_waiting or 1)
+
+    def __read_file_chunks(self):
+        fd = os.open(self.device_path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while not self.stopped.is_set():
+                readable, _, _ = select.select([fd], [], [], POLL_INTERVAL)
+                if not readable:
+                    continue
+                chunk = os.read(fd, 1024)
+                if not chunk:
+                    # The writer of a pipe went away: wait for the next one
+                    self.stopped.wait(POLL_INTERVAL)
+                yield chunk
+        finally:
+            os.close(fd)
+
+    def __handle_line(self, line):
+        raw_code = line.decode("ascii", errors="replace")
+        rfid_code = normalize_rfid(raw_code)
+        if rfid_code is None:
+            if raw_code.strip():
+                logger.warning("Ignoring invalid card read '{}'".format(raw_code.strip()))
+            return
+        if self.debouncer.accept(rfid_code):
+            self.on_scan(rfid_code)
+
+    def __run(self):
+        logger.info("Reading cards from '{}'".format(self.device_path))
+        buffer = b""
+        try:
+            chunks = self.__read_serial_chunks() if self.serial_port else self.__read_file_chunks()
+            for chunk in chunks:
+                # Readers end each card with CR, LF or both
+                *lines, buffer = (buffer + chunk).replace(b"\r", b"\n").split(b"\n")
+                for line in lines:
+                    self.__handle_line(line)
+        except Exception as e:
+            logger.exception("Card reader '{}' failed".format(self.device_path))
+            self.error = e
+            if self.on_error:
+                self.on_error(e)
+        logger.info("Stopped reading cards from '{}'".format(self.device_path))
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+import logging
+from odoo_connection_handler import CONNECTION_ERRORS
+from rfid_journal import RfidJournal
+import threading
+import xmlrpc.client
+
+logger = logging.getLogger(__name__)
+
+# Error covers Fault, ProtocolError and ResponseError
+ODOO_ERRORS = (xmlrpc.client.Error,) + CONNECTION_ERRORS
+
+
+class RfidWriteQueue(object):
+    """Writes the RFID assignments of an RfidJournal to Odoo in batches from a background thread.
+
+    ``put`` only records the assignment in the journal, so it never waits on the network
+    and nothing is lost if Odoo can not be reached or the program stops. Before writing a
+    batch, the current Odoo values are read: an assignment is a conflict if the user
+    already has a different card, the card belongs to someone else or an earlier entry
+    of the same batch already gives it to another user. The outcome of
+    every batch is passed to ``on_flushed`` as ``{user_id: journal status}``.
+    """
+
+    DEFAULT_BATCH_SIZE = 50
+    DEFAULT_FLUSH_INTERVAL = 2.0
+    DEFAULT_MAX_ATTEMPTS = 3
+    # Enough for a last flush to a responsive Odoo; the journal keeps whatever is left
+    CLOSE_TIMEOUT = 5.0 # seconds
+
+    def __init__(self, odoo_connection, journal, on_flushed=None, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.odoo_connection = odoo_connection
+        self.journal = journal
+        self.on_flushed = on_flushed
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.__run, name="rfid-write-queue", daemon=True)
+        self.thread.start()
+
+    def put(self, user_id, rfid_code, previous_rfid=""):
+        self.put_many([(user_id, rfid_code, previous_rfid)])
+
+    def put_many(self, assignments):
+        """Queue [(user_id, rfid_code, previous_rfid)], where previous_rfid is the value Odoo is expected to have."""
+        self.journal.add(assignments)
+        with self.condition:
+            self.condition.notify()
+
+    def pending_count(self):
+        return self.journal.count()
+
+    def stop(self, timeout=None):
+        """Try to flush what is pending and stop the background thread. Whatever is left stays in the journal."""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread:
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logger.warning("The last RFID writes did not finish in {} seconds".format(timeout))
+        self.thread = None
+        pending = self.pending_count()
+        if pending:
+            logger.warning("{} RFID assignment(s) will be written to Odoo the next time".format(pending))
+
+    def __read_rfid_codes(self, entries):
+        users = self.odoo_connection.read(self.odoo_connection.USERS_MODEL, sorted({entry.user_id for entry in entries}), [self.odoo_connection.RFID_FIELD])
+        return {user["id"]: user.get(self.odoo_connection.RFID_FIELD) or "" for user in users}
+
+    def __read_rfid_owners(self, entries):
+        rfid_field = self.odoo_connection.RFID_FIELD
+        domain = [(rfid_field, "in", sorted({entry.rfid_code for entry in entries}))]
+        return {owner.get(rfid_field): owner["id"] for owner in self.odoo_connection.search_read(self.odoo_connection.USERS_MODEL, domain, [rfid_field])}
+
+    def __reconcile(self, entries, outcome):
+        """Settle the entries that must not be written. Return the ones that must."""
+        rfid_codes_by_user = self.__read_rfid_codes(entries)
+        owners_by_rfid = self.__read_rfid_owners(entries)
+        already_written = []
+        to_write = []
+        # Users that get a card in this batch: write_users_rfid would write them all together
+        batch_owners_by_rfid = {}
+        for entry in entries:
+            owner_id = owners_by_rfid.get(entry.rfid_code)
+            batch_owner_id = batch_owners_by_rfid.get(entry.rfid_code)
+            if entry.user_id not in rfid_codes_by_user:
+                reason = "The user no longer exists"
+            elif rfid_codes_by_user[entry.user_id] == entry.rfid_code:
+                already_written.append(entry)
+                continue
+            elif owner_id is not None and owner_id != entry.user_id:
+                reason = "The card belongs to the user {} in Odoo".format(owner_id)
+            elif batch_owner_id is not None:
+                reason = "The card is also being written to the user {}".format(batch_owner_id)
+            elif rfid_codes_by_user[entry.user_id] != entry.previous_rfid:
+                reason = "The user has the card '{}' in Odoo".format(rfid_codes_by_user[entry.user_id])
+            else:
+                batch_owners_by_rfid[entry.rfid_code] = entry.user_id
+                to_write.append(entry)
+                continue
+            logger.warning("RFID code '{}' not written to the user {}: {}".format(entry.rfid_code, entry.user_id, reason))
+            self.journal.mark_conflict(entry, reason)
+            outcome[entry.user_id] = RfidJournal.CONFLICT
+        self.journal.mark_written(already_written)
+        outcome.update({entry.user_id: RfidJournal.WRITTEN for entry in already_written})
+        return to_write
+
+    def __flush(self, entries):
+        """Write one batch. Return False if some of it stays pending, because Odoo could not be reached or will be tried again."""
+        outcome = {}
+        try:
+            to_write = self.__reconcile(entries, outcome)
+            results = self.odoo_connection.write_users_rfid({entry.user_id: entry.rfid_code for entry in to_write}) if to_write else {}
+            written = [entry for entry in to_write if results.get(entry.user_id)]
+            not_written = [entry for entry in to_write if not results.get(entry.user_id)]
+            if not_written:
+                # Tells a lost response from a rejected write, and an unreachable server from both
+                rfid_codes_by_user = self.__read_rfid_codes(not_written)
+                written += [entry for entry in not_written if rfid_codes_by_user.get(entry.user_id) == entry.rfid_code]
+                not_written = [entry for entry in not_written if rfid_codes_by_user.get(entry.user_id) != entry.rfid_code]
+        except ODOO_ERRORS as e:
+            logger.warning("{} RFID assignment(s) stay pending, Odoo could not be reached or failed: '{}'".format(len(entries), e))
+            if outcome and self.on_flushed:
+                self.on_flushed(outcome)
+            return False
+        self.journal.mark_written(written)
+        outcome.update({entry.user_id: RfidJournal.WRITTEN for entry in written})
+        failed = self.journal.mark_attempt_failed(not_written, self.max_attempts)
+        outcome.update({entry.user_id: RfidJournal.FAILED for entry in failed})
+        if outcome and self.on_flushed:
+            self.on_flushed(outcome)
+        return len(failed) == len(not_written)
+
+    def __run(self):
+        while True:
+            with self.condition:
+                if not self.stopping:
+                    self.condition.wait(self.flush_interval)
+                stopping = self.stopping
+            # Drain the journal. Whatever stays pending waits for the next interval
+            try:
+                while True:
+                    entries = self.journal.get_pending(self.batch_size)
+                    if not entries or not self.__flush(entries):
+                        break
+            except Exception:
+                # E.g. a locked journal: the thread must keep running to try again
+                logger.exception("RFID assignments could not be written, they will be tried again")
+            if stopping:
+                return
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore(object):
+    """Last synchronized Odoo records saved in a local SQLite file, one compressed row per server, database and model.
+
+    Delta refreshes only add the records that changed as separate rows, which are merged
+    when the snapshot is loaded and folded into a full save once there are too many.
+    """
+
+    DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".ule-rfid-manager", "snapshots.sqlite3")
+    DEFAULT_STALE_AFTER = 12 * 60 * 60 # seconds
+    # Changed records kept apart before a full save is needed, as a share of all the records
+    MAX_CHANGES_RATIO = 0.2
+    MIN_MAX_CHANGES = 1000
+
+    def __init__(self, url, db, path=DEFAULT_PATH, stale_after=DEFAULT_STALE_AFTER):
+        self.url = url
+        self.db = db
+        self.path = path
+        self.stale_after = stale_after
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.__connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                               "url TEXT NOT NULL, db TEXT NOT NULL, model TEXT NOT NULL, "
+                               "fields TEXT, last_sync TEXT, saved_at REAL NOT NULL, records BLOB NOT NULL, "
+                               "PRIMARY KEY (url, db, model))")
+            # A NULL record means that it was deleted
+            connection.execute("CREATE TABLE IF NOT EXISTS snapshot_changes ("
+                               "url TEXT NOT NULL, db TEXT NOT NULL, model TEXT NOT NULL, record_id INTEGER NOT NULL, record TEXT, "
+                               "PRIMARY KEY (url, db, model, record_id))")
+
+    def __connect(self):
+        # A new connection per operation so the store can be used from background threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def is_stale(self, saved_at):
+        return time.time() - saved_at > self.stale_after
+
+    def load(self, model):
+        """Return (records, fields, last_sync, saved_at) or None if there is no usable snapshot."""
+        try:
+            with self.__connect() as connection:
+                row = connection.execute("SELECT fields, last_sync, saved_at, records FROM snapshots WHERE url = ? AND db = ? AND model = ?",
+                                         (self.url, self.db, model)).fetchone()
+                changes = connection.execute("SELECT record_id, record FROM snapshot_changes WHERE url = ? AND db = ? AND model = ?",
+                                             (self.url, self.db, model)).fetchall()
+        except sqlite3.Error as e:
+            logger.warning("Snapshot of '{}' could not be read: '{}'".format(model, e))
+            return None
+        if not row:
+            return None
+
+        fields, last_sync, saved_at, records = row
+        try:
+            records = json.loads(zlib.decompress(records).decode("utf-8"))
+            fields = json.loads(fields) if fields else None
+            if changes:
+                records_by_id = {record.get("id"): record for record in records}
+                for record_id, record in changes:
+                    if record is None:
+                        records_by_id.pop(record_id, None)
+                    else:
+                        records_by_id[record_id] = json.loads(record)
+                records = list(records_by_id.values())
+        except (zlib.error, ValueError) as e:
+            logger.warning("Snapshot of '{}' is corrupted: '{}'".format(model, e))
+            return None
+        return records, fields, last_sync, saved_at
+
+    def save(self, model, records, fields, last_sync):
+        """Save all the records of the model. Return whether it worked."""
+        payload = zlib.compress(json.dumps(records, separators=(",", ":")).encode("utf-8"))
+        try:
+            with self.__connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO snapshots (url, db, model, fields, last_sync, saved_at, records) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (self.url, self.db, model, json.dumps(fields) if fields else None, last_sync, time.time(), payload))
+                connection.execute("DELETE FROM snapshot_changes WHERE url = ? AND db = ? AND model = ?", (self.url, self.db, model))
+        except sqlite3.Error as e:
+            logger.warning("Snapshot of '{}' could not be saved: '{}'".format(model, e))
+            return False
+        return True
+
+    def save_changes(self, model, changed_records, deleted_ids, fields, last_sync, record_count):
+        """Add the records changed since the last save. Return False if a full save is needed instead."""
+        try:
+            with self.__connect() as connection:
+                saved = connection.execute("SELECT fields FROM snapshots WHERE url = ? AND db = ? AND model = ?", (self.url, self.db, model)).fetchone()
+                if not saved or saved[0] != (json.dumps(fields) if fields else None):
+                    return False
+                pending = connection.execute("SELECT COUNT(*) FROM snapshot_changes WHERE url = ? AND db = ? AND model = ?",
+                                             (self.url, self.db, model)).fetchone()[0]
+                if pending + len(changed_records) + len(deleted_ids) > max(self.MIN_MAX_CHANGES, record_count * self.MAX_CHANGES_RATIO):
+                    return False
+                rows = [(self.url, self.db, model, record.get("id"), json.dumps(record, separators=(",", ":"))) for record in changed_records]
+                rows.extend((self.url, self.db, model, record_id, None) for record_id in deleted_ids)
+                connection.executemany("INSERT OR REPLACE INTO snapshot_changes (url, db, model, record_id, record) VALUES (?, ?, ?, ?, ?)", rows)
+                connection.execute("UPDATE snapshots SET last_sync = ?, saved_at = ? WHERE url = ? AND db = ? AND model = ?",
+                                   (last_sync, time.time(), self.url, self.db, model))
+        except sqlite3.Error as e:
+            logger.warning("Changes of the snapshot of '{}' could not be saved: '{}'".format(model, e))
+            return False
+        return True
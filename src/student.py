@@ -5,34 +5,75 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+class CourseTable(object):
+    """Names of the Odoo courses (op.course) shared by every student, which only keep the course ids."""
+
+    def __init__(self):
+        self.names = {}
+        self.ids = {}
+
+    def set_names(self, names):
+        """Replace the names with {course_id: name}. Renamed courses keep their students."""
+        ids = {}
+        for course_id, course_name in names.items():
+            ids.setdefault(course_name, []).append(course_id)
+        self.names = dict(names)
+        self.ids = {course_name: tuple(course_ids) for course_name, course_ids in ids.items()}
+
+    def get_ids(self, course_name):
+        # Different courses may share a name
+        return self.ids.get(course_name, ())
+
+
+course_table = CourseTable()
+
+
 class Student(object):
 
     BARCODE_LENGTH = 9 # 8 digits + 1 letter
 
-    def __init__(self, student_id, user_id="", name="", identification_code="", student_code="", courses=[], rfid_code=''):
-        self.student_id = student_id
-        self.user_id = user_id
-        self.name = name
-        self.identification_code = identification_code
-        self.student_code = str(student_code)
-        self.courses = courses
-        self.rfid_code = rfid_code
+    __slots__ = ("student_id", "user_id", "name", "identification_code", "student_code", "course_ids", "rfid_code", "cached_barcode", "cached_array")
 
-    def get_barcode(self):
-        if self.student_code:
-            previous_zeros = self.BARCODE_LENGTH - len(self.student_code)
-            prefix = "0" * previous_zeros
-            return prefix + self.student_code
-        else:
-            return self.identification_code
+    def __init__(self, student_id, user_id="", name="", identification_code="", student_code="", course_ids=(), rfid_code=''):
+        set_attribute = super().__setattr__
+        set_attribute("student_id", student_id)
+        set_attribute("user_id", user_id)
+        set_attribute("name", name)
+        set_attribute("identification_code", identification_code)
+        set_attribute("student_code", str(student_code))
+        set_attribute("course_ids", frozenset(course_ids))
+        set_attribute("rfid_code", rfid_code)
+        set_attribute("cached_barcode", None)
+        set_attribute("cached_array", None)
 
-    def is_in_course(self, course_name):
-        return course_name in self.courses
+    def __setattr__(self, name, value):
+        raise AttributeError("Student is immutable, use replace() to change '{}'".format(name))
 
-    def to_array(self):
-        return [self.name, self.identification_code, self.student_code, self.rfid_code]
+    def replace(self, **changes):
+        values = {
+            "student_id": self.student_id,
+            "user_id": self.user_id,
+            "name": self.name,
+            "identification_code": self.identification_code,
+            "student_code": self.student_code,
+            "course_ids": self.course_ids,
+            "rfid_code": self.rfid_code,
+        }
+        values.update(changes)
+        return Student(**values)
 
-    def export_to_csv(self):
-        barcode = self.get_barcode()
-        csv_line = "{},{},{},{},{}".format(self.name, self.identification_code, self.student_code, barcode, self.rfid_code)
-        return csv_line
\ No newline at end of file
+    def get_barcode(self):
+        if self.cached_barcode is None:
+            if self.student_code:
+                previous_zeros = self.BARCODE_LENGTH - len(self.student_code)
+                prefix = "0" * previous_zeros
+                barcode = prefix + self.student_code
+            else:
+                barcode = self.identification_code
+            super().__setattr__("cached_barcode", barcode)
+        return self.cached_barcode
+
+    def to_array(self):
+        if self.cached_array is None:
+            super().__setattr__("cached_array", [self.name, self.identification_code, self.student_code, self.rfid_code])
+        return self.cached_array
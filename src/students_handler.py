@@ -1,133 +1,318 @@
 #!/usr/bin/env python3
 
 import collections
+from csv_importer import import_rfid_codes
+from exporter import export_rows
+from rfid_diff import csv_source_rows, diff_rfid_codes, people_source_rows
 import logging
-from student import Student
+from odoo_repository import OdooRepository
+from refresh_join import get_enrollment_courses, join_students, paused_gc
+from student import course_table
+from timing import timed
 
 logger = logging.getLogger(__name__)
 
 
-def from_odoo_list_to_dict(element_list):
-    if not isinstance(element_list, list):
-        return {}
-    return { element.get("id"): element for element in element_list}
-
-
 class StudentsHandler(object):
 
     csv_headline = "Nombre,DNI,Código alumno,Barcode,RFID"
 
-    def __init__(self, odoo_connection):
+    export_columns = collections.OrderedDict([
+        ("Nombre", lambda student: student.name),
+        ("DNI", lambda student: student.identification_code),
+        ("Código alumno", lambda student: student.student_code),
+        ("Barcode", lambda student: student.get_barcode()),
+        ("RFID", lambda student: student.rfid_code),
+    ])
+
+    odoo_fields = {
+        "op.course": ["display_name"],
+        "op.student.course": ["course_id"],
+        "op.student": ["display_name", "identification_code", "gr_no", "course_detail_ids", "user_id"],
+        "res.users": ["kardex_remstar_xp_rfid"],
+    }
+
+    def __init__(self, odoo_connection, repository=None):
         self.odoo_connection = odoo_connection
+        self.repository = repository or OdooRepository(odoo_connection)
         self.all_students = collections.OrderedDict()
         self.selected_students = collections.OrderedDict()
-        self.courses = None
-        self.enrollments = None
-        self.users = None
-        self.__refresh_info()
-
-    def __refresh_info(self):
-        self.courses = from_odoo_list_to_dict(self.odoo_connection.get_all_courses())
-        self.enrollments = from_odoo_list_to_dict(self.odoo_connection.get_all_enrollments())
-        self.users = from_odoo_list_to_dict(self.odoo_connection.get_all_users())
-
-    def __get_student_courses(self, odoo_student):
-        course_detail_ids = odoo_student.get("course_detail_ids")
-        student_courses = set()
-        for course_detail_id in course_detail_ids:
-            course_name = self.enrollments.get(course_detail_id).get("course_id")[1]
-            student_courses.add(course_name)
-        return student_courses
-
-    def __get_student_user(self, odoo_student):
-        try:
-            student_user_id = odoo_student.get("user_id")[0]
-            return self.users.get(student_user_id)
-        except TypeError:
-            return None
+        self.students_by_identification_code = {}
+        self.students_by_student_code = {}
+        self.students_by_rfid = {}
+        self.students_by_course = {}
+        self.students_without_rfid = set()
+        self.filtered_views = {}
+        self.selected_filter = ("", True)
+        self.courses_cache = self.repository.get_cache("op.course", self.odoo_fields["op.course"])
+        self.enrollments_cache = self.repository.get_cache("op.student.course", self.odoo_fields["op.student.course"])
+        self.users_cache = self.repository.get_cache("res.users", self.odoo_fields["res.users"])
+        self.students_cache = self.repository.get_cache("op.student", self.odoo_fields["op.student"])
+        self.courses = self.courses_cache.records
+        self.enrollments = self.enrollments_cache.records
+        self.users = self.users_cache.records
+        self.course_ids_by_enrollment = {}
+        self.synced_revisions = {}
+        self.needs_full_reload = False
+        self.load_snapshot()
 
-    def __search_local_student(self, identification_code): # Should be replaced by student code
-        for id, student in self.all_students.items():
-            if student.identification_code == identification_code:
-                return id
+    @timed("students.fetch")
+    def __refresh_info(self, incremental=False, progress=None):
+        # Students go first: they define which users must be downloaded
+        caches = (self.students_cache, self.courses_cache, self.enrollments_cache, self.users_cache)
+        for index, cache in enumerate(caches):
+            self.repository.refresh(cache.model, incremental)
+            if progress:
+                progress(index + 1, len(caches))
 
-    def write_rfid_codes(self, info):
-        for student_id, new_rfid in info.items():
-            student_user_id = self.all_students[student_id].user_id
-            self.odoo_connection.write_user_rfid(student_user_id, new_rfid)
+    @timed("students.index")
+    def __build_indexes(self):
+        with paused_gc():
+            self.students_by_identification_code.clear()
+            self.students_by_student_code.clear()
+            self.students_by_rfid.clear()
+            self.students_by_course.clear()
+            self.students_without_rfid.clear()
+            self.filtered_views.clear()
+            by_identification_code = self.students_by_identification_code
+            by_student_code = self.students_by_student_code
+            by_rfid = self.students_by_rfid
+            by_course = self.students_by_course
+            without_rfid = self.students_without_rfid
+            repeated_rfid_codes = 0
+            for student_id, student in self.all_students.items():
+                if student.identification_code:
+                    by_identification_code[student.identification_code] = student_id
+                if student.student_code:
+                    by_student_code[student.student_code] = student_id
+                if student.rfid_code:
+                    if student.rfid_code in by_rfid:
+                        repeated_rfid_codes += 1
+                    by_rfid[student.rfid_code] = student_id
+                else:
+                    without_rfid.add(student_id)
+                for course_id in student.course_ids:
+                    by_course.setdefault(course_id, []).append(student_id)
+            if repeated_rfid_codes:
+                logger.warning("{} RFID code(s) are assigned to more than one student".format(repeated_rfid_codes))
+
+    def __search_local_student(self, identification_code, student_code=""):
+        student_id = self.students_by_identification_code.get(identification_code)
+        if student_id is None and student_code:
+            student_id = self.students_by_student_code.get(student_code)
+        return student_id
+
+    def find_rfid_owner(self, rfid_code):
+        return self.students_by_rfid.get(rfid_code)
+
+    def __set_local_rfid(self, student_id, new_rfid):
+        student = self.all_students[student_id]
+        if self.students_by_rfid.get(student.rfid_code) == student_id:
+            del self.students_by_rfid[student.rfid_code]
+        student = student.replace(rfid_code=new_rfid)
+        self.all_students[student_id] = student
+        if new_rfid:
+            self.students_by_rfid[new_rfid] = student_id
+            self.students_without_rfid.discard(student_id)
+        else:
+            self.students_without_rfid.add(student_id)
+        return student
+
+    def __check_assignment(self, student_id, rfid_code):
+        student = self.all_students.get(student_id)
+        if student is None:
+            raise AttributeError("The selected student no longer exists")
+        if student.rfid_code:
+            raise AttributeError("{} already has the card '{}'".format(student.name, student.rfid_code))
+        owner_id = self.find_rfid_owner(rfid_code)
+        if owner_id is not None:
+            raise AttributeError("The card '{}' is already assigned to {}".format(rfid_code, self.all_students[owner_id].name))
+
+    def assign_rfid(self, student_id, rfid_code):
+        """Assign a scanned card to a student locally and return the updated student. Writing it to Odoo is up to the caller."""
+        self.__check_assignment(student_id, rfid_code)
+        student = self.__set_local_rfid(student_id, rfid_code)
+        self.filtered_views.clear()
+        self.filter(*self.selected_filter)
+        return student
+
+    def assign_rfid_codes(self, info):
+        """Assign {student_id: rfid_code} locally like assign_rfid, filtering only once.
+
+        Return ({student_id: updated student}, {student_id: error message}).
+        """
+        assigned = {}
+        errors = {}
+        for student_id, rfid_code in info.items():
+            try:
+                self.__check_assignment(student_id, rfid_code)
+            except AttributeError as e:
+                errors[student_id] = str(e)
+                continue
+            assigned[student_id] = self.__set_local_rfid(student_id, rfid_code)
+        if assigned:
+            self.filtered_views.clear()
+            self.filter(*self.selected_filter)
+        return assigned, errors
+
+    @timed("students.write")
+    def write_rfid_codes(self, info, progress=None):
+        student_ids_by_user = {self.all_students[student_id].user_id: student_id for student_id in info.keys()}
+        rfid_codes = {self.all_students[student_id].user_id: new_rfid for student_id, new_rfid in info.items()}
+        user_results = self.odoo_connection.write_users_rfid(rfid_codes, progress=progress)
+        self.repository.invalidate(self.users_cache.model)
+
+        results = {}
+        for user_id, success in user_results.items():
+            student_id = student_ids_by_user[user_id]
+            results[student_id] = success
+            if success:
+                self.__set_local_rfid(student_id, info[student_id])
+        self.filtered_views.clear()
+        self.filter(*self.selected_filter)
+        return results
 
     def get_courses_names(self):
         return [course.get("display_name") for course in self.courses.values()]
 
-    def refresh_students(self):
-        self.all_students.clear()
-        self.selected_students.clear()
-        self.__refresh_info()
-        odoo_students = self.odoo_connection.get_all_students()
-        for odoo_student in odoo_students:
-            student_id = odoo_student.get("id")
-            student_name = odoo_student.get("display_name")
-            student_identification_code = odoo_student.get("identification_code") or ""
-            student_gr_no = odoo_student.get("gr_no") or ""
-            student_courses = self.__get_student_courses(odoo_student)
-            student_user = self.__get_student_user(odoo_student)
-            if not student_user:
-                logger.error("User for student '{}' does not exist".format(student_name))
-                continue
-            user_id = student_user.get("id")
-            student_rfid = student_user.get("kardex_remstar_xp_rfid") or ""
-            student = Student(student_id, user_id, student_name, student_identification_code, student_gr_no, student_courses, student_rfid)
-            self.all_students[student_id] = student
+    def __join_students(self, odoo_students, previous=None):
+        return join_students(odoo_students, self.course_ids_by_enrollment, self.users, "kardex_remstar_xp_rfid", previous)
 
-        self.selected_students = self.all_students
+    def __get_changed_students(self):
+        # None means that a full rebuild is needed
+        course_changes = self.courses_cache.changes_since(self.synced_revisions.get("op.course", 0))
+        enrollment_changes = self.enrollments_cache.changes_since(self.synced_revisions.get("op.student.course", 0))
+        user_changes = self.users_cache.changes_since(self.synced_revisions.get("res.users", 0))
+        student_changes = self.students_cache.changes_since(self.synced_revisions.get("op.student", 0))
+        if None in (course_changes, enrollment_changes, user_changes, student_changes):
+            return None
+        if any(course_changes) or any(enrollment_changes):
+            return None
 
-    def filter(self, course_name="", with_rfid=True):
-        course_filtered_students = { id: student for id, student in self.all_students.items() if student.is_in_course(course_name)} if course_name else self.all_students
-        if with_rfid:
-            self.selected_students = course_filtered_students
+        changed_student_ids, deleted_student_ids = student_changes
+        changed_user_ids = set().union(*user_changes)
+        if changed_user_ids:
+            changed_student_ids |= {student_id for student_id, odoo_student in self.students_cache.records.items()
+                                   if odoo_student.get("user_id") and odoo_student.get("user_id")[0] in changed_user_ids}
+        return changed_student_ids, deleted_student_ids
+
+    @timed("students.join")
+    def __rebuild_students(self):
+        with paused_gc():
+            # Patches only happen while the enrollments do not change, so they reuse this map
+            self.course_ids_by_enrollment = get_enrollment_courses(self.enrollments, self.courses)
+            students = self.__join_students(self.students_cache.records.values(), self.all_students)
+            self.all_students.clear()
+            self.all_students.update(students)
+
+    @timed("students.join")
+    def __patch_students(self, changed_student_ids, deleted_student_ids):
+        for student_id in deleted_student_ids:
+            self.all_students.pop(student_id, None)
+        odoo_students = self.students_cache.records
+        students = dict(self.__join_students(odoo_students[student_id] for student_id in changed_student_ids if student_id in odoo_students))
+        for student_id in changed_student_ids:
+            student = students.get(student_id)
+            if student:
+                self.all_students[student_id] = student
+            else:
+                self.all_students.pop(student_id, None)
+        logger.info("{} student(s) updated, {} removed".format(len(changed_student_ids), len(deleted_student_ids)))
+
+    def __get_revisions(self):
+        return {cache.model: cache.revision for cache in (self.courses_cache, self.enrollments_cache, self.users_cache, self.students_cache)}
+
+    def load_snapshot(self):
+        """Build the students from the local snapshot without contacting Odoo. Return False if there is no complete snapshot."""
+        snapshots_freshness = [self.repository.load_snapshot(cache.model) for cache in (self.courses_cache, self.enrollments_cache, self.users_cache, self.students_cache)]
+        if None in snapshots_freshness:
+            return False
+        revisions = self.__get_revisions()
+        self.__rebuild_students()
+        self.synced_revisions.update(revisions)
+        self.__build_indexes()
+        self.filter()
+        # A stale snapshot is only good for showing something while the next refresh reloads everything
+        self.needs_full_reload = not all(snapshots_freshness)
+        return True
+
+    def refresh_students(self, incremental=False, progress=None):
+        incremental = incremental and not self.needs_full_reload
+        self.needs_full_reload = False
+        self.__refresh_info(incremental, progress)
+        # Taken before looking for changes: the shared caches may keep changing in other threads
+        revisions = self.__get_revisions()
+        changed_students = self.__get_changed_students() if incremental else None
+        if changed_students is None:
+            self.__rebuild_students()
         else:
-            self.selected_students = { id: student for id, student in course_filtered_students.items() if not student.rfid_code}
+            self.__patch_students(*changed_students)
 
+        self.synced_revisions.update(revisions)
+        self.__build_indexes()
+        self.filter()
+
+    def __get_course_student_ids(self, course_name):
+        course_ids = course_table.get_ids(course_name)
+        if len(course_ids) == 1:
+            return self.students_by_course.get(course_ids[0], [])
+        # Courses that share a name are shown together
+        return list(dict.fromkeys(student_id for course_id in course_ids for student_id in self.students_by_course.get(course_id, [])))
+
+    @timed("students.filter")
+    def filter(self, course_name="", with_rfid=True):
+        # Every (course, with_rfid) selection is computed once per refresh from the indexes
+        self.selected_filter = (course_name, with_rfid)
+        view = self.filtered_views.get(self.selected_filter)
+        if view is None:
+            if not course_name and with_rfid:
+                selected_students = self.all_students
+            else:
+                student_ids = self.__get_course_student_ids(course_name) if course_name else self.all_students.keys()
+                if not with_rfid:
+                    student_ids = [student_id for student_id in student_ids if student_id in self.students_without_rfid]
+                selected_students = collections.OrderedDict((student_id, self.all_students[student_id]) for student_id in student_ids)
+            view = [selected_students, None]
+            self.filtered_views[self.selected_filter] = view
+        self.selected_students = view[0]
+
+    @timed("students.build_list")
     def build_list(self):
-        return [student.to_array() for student in self.selected_students.values()]
+        view = self.filtered_views.get(self.selected_filter)
+        if view is None or view[0] is not self.selected_students:
+            return [student.to_array() for student in self.selected_students.values()]
+        if view[1] is None:
+            view[1] = [student.to_array() for student in self.selected_students.values()]
+        return view[1]
 
-    def export_to_csv(self):
-        csv_content = ""
-        csv_content = self.csv_headline + "\n"
-        for student in self.selected_students.values():
-            new_line = student.export_to_csv()
-            csv_content = csv_content + new_line + "\n"
+    @timed("students.export")
+    def export(self, file_path, columns=None, file_format=None):
+        """Export the selected students. By default with the columns of csv_headline, so the file can be imported back."""
+        columns = columns or list(self.export_columns.keys())
+        getters = [self.export_columns[column] for column in columns]
+        rows = ([getter(student) for getter in getters] for student in self.selected_students.values())
+        export_rows(file_path, columns, rows, file_format)
 
-        with open('students.csv', 'w') as f:
-            f.write(csv_content)
+    def export_to_csv(self, file_path="students.csv"):
+        self.export(file_path, file_format="csv")
 
+    def __find_csv_student(self, row):
+        return self.__search_local_student(row.get("DNI"), row.get("Código alumno"))
+
+    def __get_student_rfid(self, student_id):
+        return self.all_students[student_id].rfid_code
+
+    @timed("students.import")
     def import_csv(self, file_path):
-        if not file_path:
-            raise AttributeError("No file selected")
-
-        new_rfid_codes = {}
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-            if len(lines) <= 1:
-                raise AttributeError("No valid data")
-
-            headline = lines[0].strip()
-            if headline != self.csv_headline:
-                raise AttributeError("Invalid headline format")
-
-            student_lines = lines[1:]
-            for student_line in student_lines:
-                student_line_list = student_line.strip().split(",")
-                identification_code = student_line_list[1] # Should be replaced by student code
-                new_rfid_code = student_line_list[4]
-                student_id = self.__search_local_student(identification_code)
-                if not student_id:
-                    logger.error(f"Student with student code '{identification_code}' does not exist") # Should be replaced by student code
-                    continue
-                if self.all_students.get(student_id).rfid_code:
-                    logger.warn(f"Student '{student_id}'' already has an RFID code assigned")
-                    continue
-
-                new_rfid_codes[student_id] = new_rfid_code
-                
-        return new_rfid_codes
\ No newline at end of file
+        return import_rfid_codes(file_path, self.csv_headline.split(","), self.__find_csv_student, self.__get_student_rfid, self.find_rfid_owner)
+
+    @timed("students.diff")
+    def diff_csv(self, file_path):
+        rows = csv_source_rows(file_path, self.csv_headline.split(","))
+        return diff_rfid_codes(rows, self.__find_csv_student, self.__get_student_rfid, self.find_rfid_owner, file_path)
+
+    @timed("students.diff")
+    def diff_students(self, students, source=""):
+        """Compare the RFID codes of the students of another handler, e.g. one of a test database, matched by DNI."""
+        rows = people_source_rows(students, self.export_columns)
+        return diff_rfid_codes(rows, self.__find_csv_student, self.__get_student_rfid, self.find_rfid_owner, source)
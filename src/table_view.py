@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TableView(object):
+    """Pages of a handler selection, so the GUI table only receives the rows it shows.
+
+    Sorting uses one precomputed order per column and searching narrows the previous
+    matches while the user keeps typing. Both are computed once per data set.
+    """
+
+    DEFAULT_PAGE_SIZE = 30
+
+    def __init__(self, search_columns, page_size=DEFAULT_PAGE_SIZE):
+        self.search_columns = search_columns
+        self.page_size = page_size
+        self.ids = []
+        self.rows = []
+        self.page = 0
+        self.sort_column = None
+        self.sort_reverse = False
+        self.search_text = ""
+        self.sorted_positions = {}
+        self.search_keys = None
+        self.matches = None
+        self.visible_positions = []
+        self.positions_by_id = None
+
+    def set_data(self, ids, rows):
+        self.ids = ids
+        self.rows = rows
+        self.sorted_positions = {}
+        self.search_keys = None
+        self.matches = None
+        self.positions_by_id = None
+        self.page = 0
+        self.__search(self.search_text, incremental=False)
+
+    def update_row(self, record_id, row):
+        """Replace the row of one record in place, keeping the current order, search and page."""
+        if self.positions_by_id is None:
+            self.positions_by_id = {record_id: position for position, record_id in enumerate(self.ids)}
+        position = self.positions_by_id.get(record_id)
+        if position is None:
+            return False
+        self.rows[position] = row
+        # Recomputed on the next sort or search, so the row does not jump while scanning
+        self.sorted_positions = {}
+        self.search_keys = None
+        return True
+
+    def __get_sorted_positions(self, column):
+        positions = self.sorted_positions.get(column)
+        if positions is None:
+            rows = self.rows
+            positions = sorted(range(len(rows)), key=lambda position: str(rows[position][column]).lower())
+            self.sorted_positions[column] = positions
+        return positions
+
+    def __update_visible_positions(self):
+        if self.sort_column is None:
+            positions = range(len(self.rows))
+        else:
+            positions = self.__get_sorted_positions(self.sort_column)
+            if self.sort_reverse:
+                positions = reversed(positions)
+        if self.matches is None:
+            self.visible_positions = list(positions)
+        else:
+            matches = set(self.matches)
+            self.visible_positions = [position for position in positions if position in matches]
+        self.page = min(self.page, self.get_page_count() - 1)
+
+    def sort(self, column=None, reverse=False):
+        self.sort_column = column
+        self.sort_reverse = reverse
+        self.page = 0
+        self.__update_visible_positions()
+
+    def __search(self, text, incremental=True):
+        text = text.strip().lower()
+        if not text:
+            self.matches = None
+        else:
+            if self.search_keys is None:
+                self.search_keys = ["\t".join(str(row[column]) for column in self.search_columns).lower() for row in self.rows]
+            # Typing more characters can only narrow the previous result
+            candidates = self.matches if incremental and self.matches is not None and text.startswith(self.search_text) else range(len(self.rows))
+            search_keys = self.search_keys
+            self.matches = [position for position in candidates if text in search_keys[position]]
+        self.search_text = text
+        self.__update_visible_positions()
+
+    def search(self, text):
+        self.page = 0
+        self.__search(text)
+
+    def get_page_count(self):
+        return max(1, (len(self.visible_positions) + self.page_size - 1) // self.page_size)
+
+    def go_to_page(self, page):
+        self.page = max(0, min(page, self.get_page_count() - 1))
+
+    def next_page(self):
+        self.go_to_page(self.page + 1)
+
+    def previous_page(self):
+        self.go_to_page(self.page - 1)
+
+    def __get_page_positions(self):
+        start = self.page * self.page_size
+        return self.visible_positions[start:start + self.page_size]
+
+    def get_page_rows(self):
+        return [self.rows[position] for position in self.__get_page_positions()]
+
+    def get_page_ids(self):
+        return [self.ids[position] for position in self.__get_page_positions()]
+
+    def get_page_label(self):
+        return "Page {} of {} ({} rows)".format(self.page + 1, self.get_page_count(), len(self.visible_positions))
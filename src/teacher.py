@@ -6,20 +6,36 @@ logger = logging.getLogger(__name__)
 
 
 class Teacher(object):
+
+    __slots__ = ("teacher_id", "user_id", "name", "identification_code", "rfid_code", "cached_array")
+
     def __init__(self, teacher_id, user_id="", name="", identification_code="", rfid_code=''):
-        self.teacher_id = teacher_id
-        self.user_id = user_id
-        self.name = name
-        self.identification_code = identification_code
-        self.rfid_code = rfid_code
+        set_attribute = super().__setattr__
+        set_attribute("teacher_id", teacher_id)
+        set_attribute("user_id", user_id)
+        set_attribute("name", name)
+        set_attribute("identification_code", identification_code)
+        set_attribute("rfid_code", rfid_code)
+        set_attribute("cached_array", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Teacher is immutable, use replace() to change '{}'".format(name))
+
+    def replace(self, **changes):
+        values = {
+            "teacher_id": self.teacher_id,
+            "user_id": self.user_id,
+            "name": self.name,
+            "identification_code": self.identification_code,
+            "rfid_code": self.rfid_code,
+        }
+        values.update(changes)
+        return Teacher(**values)
 
     def get_barcode(self):
         return self.identification_code
 
     def to_array(self):
-        return [self.name, self.identification_code, self.rfid_code]
-
-    def export_to_csv(self):
-        barcode = self.get_barcode()
-        csv_line = "{},{},{},{}".format(self.name, self.identification_code, barcode, self.rfid_code)
-        return csv_line
\ No newline at end of file
+        if self.cached_array is None:
+            super().__setattr__("cached_array", [self.name, self.identification_code, self.rfid_code])
+        return self.cached_array
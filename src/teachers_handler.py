@@ -1,115 +1,276 @@
 #!/usr/bin/env python3
 
 import collections
+from csv_importer import import_rfid_codes
+from exporter import export_rows
+from rfid_diff import csv_source_rows, diff_rfid_codes, people_source_rows
 import logging
-from teacher import Teacher
+from odoo_repository import OdooRepository
+from refresh_join import join_teachers, paused_gc
+from timing import timed
 
 logger = logging.getLogger(__name__)
 
 
-def from_odoo_list_to_dict(element_list):
-    if not isinstance(element_list, list):
-        return {}
-    return { element.get("id"): element for element in element_list}
-
-
 class TeachersHandler(object):
 
     csv_headline = "Nombre,DNI,Barcode,RFID"
 
-    def __init__(self, odoo_connection):
+    export_columns = collections.OrderedDict([
+        ("Nombre", lambda teacher: teacher.name),
+        ("DNI", lambda teacher: teacher.identification_code),
+        ("Barcode", lambda teacher: teacher.get_barcode()),
+        ("RFID", lambda teacher: teacher.rfid_code),
+    ])
+
+    odoo_fields = {
+        "op.faculty": ["display_name", "identification_code", "user_id"],
+        "res.users": ["kardex_remstar_xp_rfid"],
+    }
+
+    def __init__(self, odoo_connection, repository=None):
         self.odoo_connection = odoo_connection
+        self.repository = repository or OdooRepository(odoo_connection)
         self.all_teachers = collections.OrderedDict()
         self.selected_teachers = collections.OrderedDict()
-        self.users = None
-        self.__refresh_info()
+        self.teachers_by_identification_code = {}
+        self.teachers_by_rfid = {}
+        self.teachers_without_rfid = set()
+        self.filtered_views = {}
+        self.selected_filter = True
+        self.users_cache = self.repository.get_cache("res.users", self.odoo_fields["res.users"])
+        self.teachers_cache = self.repository.get_cache("op.faculty", self.odoo_fields["op.faculty"])
+        self.users = self.users_cache.records
+        self.synced_revisions = {}
+        self.needs_full_reload = False
+        self.load_snapshot()
 
-    def __refresh_info(self):
-        self.users = from_odoo_list_to_dict(self.odoo_connection.get_all_users())
+    @timed("teachers.fetch")
+    def __refresh_info(self, incremental=False, progress=None):
+        # Teachers go first: they define which users must be downloaded
+        caches = (self.teachers_cache, self.users_cache)
+        for index, cache in enumerate(caches):
+            self.repository.refresh(cache.model, incremental)
+            if progress:
+                progress(index + 1, len(caches))
 
-    def __get_teacher_user(self, odoo_teacher):
-        try:
-            teacher_user_id = odoo_teacher.get("user_id")[0]
-            return self.users.get(teacher_user_id)
-        except TypeError:
-            return None
+    @timed("teachers.index")
+    def __build_indexes(self):
+        with paused_gc():
+            self.teachers_by_identification_code.clear()
+            self.teachers_by_rfid.clear()
+            self.teachers_without_rfid.clear()
+            self.filtered_views.clear()
+            by_identification_code = self.teachers_by_identification_code
+            by_rfid = self.teachers_by_rfid
+            without_rfid = self.teachers_without_rfid
+            repeated_rfid_codes = 0
+            for teacher_id, teacher in self.all_teachers.items():
+                if teacher.identification_code:
+                    by_identification_code[teacher.identification_code] = teacher_id
+                if teacher.rfid_code:
+                    if teacher.rfid_code in by_rfid:
+                        repeated_rfid_codes += 1
+                    by_rfid[teacher.rfid_code] = teacher_id
+                else:
+                    without_rfid.add(teacher_id)
+            if repeated_rfid_codes:
+                logger.warning("{} RFID code(s) are assigned to more than one teacher".format(repeated_rfid_codes))
 
     def __search_local_teacher(self, identification_code):
-        for id, teacher in self.all_teachers.items():
-            if teacher.identification_code == identification_code:
-                return id
-
-    def write_rfid_codes(self, info):
-        for teacher_id, new_rfid in info.items():
-            teacher_user_id = self.all_teachers[teacher_id].user_id
-            self.odoo_connection.write_user_rfid(teacher_user_id, new_rfid)
-
-    def refresh_teachers(self):
-        self.all_teachers.clear()
-        self.selected_teachers.clear()
-        self.__refresh_info()
-        odoo_teachers = self.odoo_connection.get_all_teachers()
-        for odoo_teacher in odoo_teachers:
-            teacher_id = odoo_teacher.get("id")
-            teacher_name = odoo_teacher.get("display_name")
-            teacher_identification_code = odoo_teacher.get("identification_code") or ""
-            teacher_user = self.__get_teacher_user(odoo_teacher)
-            if not teacher_user:
-                logger.error("User for teacher '{}' does not exist".format(teacher_name))
+        return self.teachers_by_identification_code.get(identification_code)
+
+    def find_rfid_owner(self, rfid_code):
+        return self.teachers_by_rfid.get(rfid_code)
+
+    def __set_local_rfid(self, teacher_id, new_rfid):
+        teacher = self.all_teachers[teacher_id]
+        if self.teachers_by_rfid.get(teacher.rfid_code) == teacher_id:
+            del self.teachers_by_rfid[teacher.rfid_code]
+        teacher = teacher.replace(rfid_code=new_rfid)
+        self.all_teachers[teacher_id] = teacher
+        if new_rfid:
+            self.teachers_by_rfid[new_rfid] = teacher_id
+            self.teachers_without_rfid.discard(teacher_id)
+        else:
+            self.teachers_without_rfid.add(teacher_id)
+        return teacher
+
+    def __check_assignment(self, teacher_id, rfid_code):
+        teacher = self.all_teachers.get(teacher_id)
+        if teacher is None:
+            raise AttributeError("The selected teacher no longer exists")
+        if teacher.rfid_code:
+            raise AttributeError("{} already has the card '{}'".format(teacher.name, teacher.rfid_code))
+        owner_id = self.find_rfid_owner(rfid_code)
+        if owner_id is not None:
+            raise AttributeError("The card '{}' is already assigned to {}".format(rfid_code, self.all_teachers[owner_id].name))
+
+    def assign_rfid(self, teacher_id, rfid_code):
+        """Assign a scanned card to a teacher locally and return the updated teacher. Writing it to Odoo is up to the caller."""
+        self.__check_assignment(teacher_id, rfid_code)
+        teacher = self.__set_local_rfid(teacher_id, rfid_code)
+        self.filtered_views.clear()
+        self.filter(self.selected_filter)
+        return teacher
+
+    def assign_rfid_codes(self, info):
+        """Assign {teacher_id: rfid_code} locally like assign_rfid, filtering only once.
+
+        Return ({teacher_id: updated teacher}, {teacher_id: error message}).
+        """
+        assigned = {}
+        errors = {}
+        for teacher_id, rfid_code in info.items():
+            try:
+                self.__check_assignment(teacher_id, rfid_code)
+            except AttributeError as e:
+                errors[teacher_id] = str(e)
                 continue
-            user_id = teacher_user.get("id")
-            teacher_rfid = teacher_user.get("kardex_remstar_xp_rfid") or ""
-            teacher = Teacher(teacher_id, user_id, teacher_name, teacher_identification_code, teacher_rfid)
-            self.all_teachers[teacher_id] = teacher
+            assigned[teacher_id] = self.__set_local_rfid(teacher_id, rfid_code)
+        if assigned:
+            self.filtered_views.clear()
+            self.filter(self.selected_filter)
+        return assigned, errors
 
-        self.selected_teachers = self.all_teachers
+    @timed("teachers.write")
+    def write_rfid_codes(self, info, progress=None):
+        teacher_ids_by_user = {self.all_teachers[teacher_id].user_id: teacher_id for teacher_id in info.keys()}
+        rfid_codes = {self.all_teachers[teacher_id].user_id: new_rfid for teacher_id, new_rfid in info.items()}
+        user_results = self.odoo_connection.write_users_rfid(rfid_codes, progress=progress)
+        self.repository.invalidate(self.users_cache.model)
 
-    def filter(self, with_rfid=True):
-        if with_rfid:
-            self.selected_teachers = self.all_teachers
+        results = {}
+        for user_id, success in user_results.items():
+            teacher_id = teacher_ids_by_user[user_id]
+            results[teacher_id] = success
+            if success:
+                self.__set_local_rfid(teacher_id, info[teacher_id])
+        self.filtered_views.clear()
+        self.filter(self.selected_filter)
+        return results
+
+    def __join_teachers(self, odoo_teachers, previous=None):
+        return join_teachers(odoo_teachers, self.users, "kardex_remstar_xp_rfid", previous)
+
+    def __get_changed_teachers(self):
+        # None means that a full rebuild is needed
+        user_changes = self.users_cache.changes_since(self.synced_revisions.get("res.users", 0))
+        teacher_changes = self.teachers_cache.changes_since(self.synced_revisions.get("op.faculty", 0))
+        if user_changes is None or teacher_changes is None:
+            return None
+
+        changed_teacher_ids, deleted_teacher_ids = teacher_changes
+        changed_user_ids = set().union(*user_changes)
+        if changed_user_ids:
+            changed_teacher_ids |= {teacher_id for teacher_id, odoo_teacher in self.teachers_cache.records.items()
+                                   if odoo_teacher.get("user_id") and odoo_teacher.get("user_id")[0] in changed_user_ids}
+        return changed_teacher_ids, deleted_teacher_ids
+
+    @timed("teachers.join")
+    def __rebuild_teachers(self):
+        with paused_gc():
+            teachers = self.__join_teachers(self.teachers_cache.records.values(), self.all_teachers)
+            self.all_teachers.clear()
+            self.all_teachers.update(teachers)
+
+    @timed("teachers.join")
+    def __patch_teachers(self, changed_teacher_ids, deleted_teacher_ids):
+        for teacher_id in deleted_teacher_ids:
+            self.all_teachers.pop(teacher_id, None)
+        odoo_teachers = self.teachers_cache.records
+        teachers = dict(self.__join_teachers(odoo_teachers[teacher_id] for teacher_id in changed_teacher_ids if teacher_id in odoo_teachers))
+        for teacher_id in changed_teacher_ids:
+            teacher = teachers.get(teacher_id)
+            if teacher:
+                self.all_teachers[teacher_id] = teacher
+            else:
+                self.all_teachers.pop(teacher_id, None)
+        logger.info("{} teacher(s) updated, {} removed".format(len(changed_teacher_ids), len(deleted_teacher_ids)))
+
+    def __get_revisions(self):
+        return {cache.model: cache.revision for cache in (self.users_cache, self.teachers_cache)}
+
+    def load_snapshot(self):
+        """Build the teachers from the local snapshot without contacting Odoo. Return False if there is no complete snapshot."""
+        snapshots_freshness = [self.repository.load_snapshot(cache.model) for cache in (self.users_cache, self.teachers_cache)]
+        if None in snapshots_freshness:
+            return False
+        revisions = self.__get_revisions()
+        self.__rebuild_teachers()
+        self.synced_revisions.update(revisions)
+        self.__build_indexes()
+        self.filter()
+        # A stale snapshot is only good for showing something while the next refresh reloads everything
+        self.needs_full_reload = not all(snapshots_freshness)
+        return True
+
+    def refresh_teachers(self, incremental=False, progress=None):
+        incremental = incremental and not self.needs_full_reload
+        self.needs_full_reload = False
+        self.__refresh_info(incremental, progress)
+        # Taken before looking for changes: the shared caches may keep changing in other threads
+        revisions = self.__get_revisions()
+        changed_teachers = self.__get_changed_teachers() if incremental else None
+        if changed_teachers is None:
+            self.__rebuild_teachers()
         else:
-            self.selected_teachers = { id: teacher for id, teacher in self.all_teachers.items() if not teacher.rfid_code}
+            self.__patch_teachers(*changed_teachers)
 
+        self.synced_revisions.update(revisions)
+        self.__build_indexes()
+        self.filter()
+
+    @timed("teachers.filter")
+    def filter(self, with_rfid=True):
+        self.selected_filter = with_rfid
+        view = self.filtered_views.get(with_rfid)
+        if view is None:
+            if with_rfid:
+                selected_teachers = self.all_teachers
+            else:
+                selected_teachers = collections.OrderedDict((teacher_id, teacher) for teacher_id, teacher in self.all_teachers.items() if teacher_id in self.teachers_without_rfid)
+            view = [selected_teachers, None]
+            self.filtered_views[with_rfid] = view
+        self.selected_teachers = view[0]
+
+    @timed("teachers.build_list")
     def build_list(self):
-        return [teacher.to_array() for teacher in self.selected_teachers.values()]
+        view = self.filtered_views.get(self.selected_filter)
+        if view is None or view[0] is not self.selected_teachers:
+            return [teacher.to_array() for teacher in self.selected_teachers.values()]
+        if view[1] is None:
+            view[1] = [teacher.to_array() for teacher in self.selected_teachers.values()]
+        return view[1]
+
+    @timed("teachers.export")
+    def export(self, file_path, columns=None, file_format=None):
+        """Export the selected teachers. By default with the columns of csv_headline, so the file can be imported back."""
+        columns = columns or list(self.export_columns.keys())
+        getters = [self.export_columns[column] for column in columns]
+        rows = ([getter(teacher) for getter in getters] for teacher in self.selected_teachers.values())
+        export_rows(file_path, columns, rows, file_format)
 
-    def export_to_csv(self):
-        csv_content = ""
-        csv_content = self.csv_headline + "\n"
-        for teacher in self.selected_teachers.values():
-            new_line = teacher.export_to_csv()
-            csv_content = csv_content + new_line + "\n"
+    def export_to_csv(self, file_path="teacher.csv"):
+        self.export(file_path, file_format="csv")
 
-        with open('teacher.csv', 'w') as f:
-            f.write(csv_content)
+    def __find_csv_teacher(self, row):
+        return self.__search_local_teacher(row.get("DNI"))
 
+    def __get_teacher_rfid(self, teacher_id):
+        return self.all_teachers[teacher_id].rfid_code
+
+    @timed("teachers.import")
     def import_csv(self, file_path):
-        if not file_path:
-            raise AttributeError("No file selected")
-
-        new_rfid_codes = {}
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-            if len(lines) <= 1:
-                raise AttributeError("No valid data")
-
-            headline = lines[0].strip()
-            if headline != self.csv_headline:
-                raise AttributeError("Invalid headline format")
-
-            teacher_lines = lines[1:]
-            for teacher_line in teacher_lines:
-                teacher_line_list = teacher_line.strip().split(",")
-                identification_code = teacher_line_list[1]
-                new_rfid_code = teacher_line_list[3]
-                teacher_id = self.__search_local_teacher(identification_code)
-                if not teacher_id:
-                    logger.error(f"Teacher with identification code '{identification_code}' does not exist")
-                    continue
-                if self.all_teachers.get(teacher_id).rfid_code:
-                    logger.warn(f"Teacher '{teacher_id}' already has an RFID code assigned")
-                    continue
-
-                new_rfid_codes[teacher_id] = new_rfid_code
-                
-        return new_rfid_codes
\ No newline at end of file
+        return import_rfid_codes(file_path, self.csv_headline.split(","), self.__find_csv_teacher, self.__get_teacher_rfid, self.find_rfid_owner)
+
+    @timed("teachers.diff")
+    def diff_csv(self, file_path):
+        rows = csv_source_rows(file_path, self.csv_headline.split(","))
+        return diff_rfid_codes(rows, self.__find_csv_teacher, self.__get_teacher_rfid, self.find_rfid_owner, file_path)
+
+    @timed("teachers.diff")
+    def diff_teachers(self, teachers, source=""):
+        """Compare the RFID codes of the teachers of another handler, e.g. one of a test database, matched by DNI."""
+        rows = people_source_rows(teachers, self.export_columns)
+        return diff_rfid_codes(rows, self.__find_csv_teacher, self.__get_teacher_rfid, self.find_rfid_owner, source)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import atexit
+import contextlib
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SpanStats(object):
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.min_time = None
+        self.max_time = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.min_time = elapsed if self.min_time is None else min(self.min_time, elapsed)
+        self.max_time = max(self.max_time, elapsed)
+
+    def to_dict(self):
+        return {"count": self.count, "total_time": self.total_time, "average_time": self.total_time / self.count if self.count else 0.0,
+                "min_time": self.min_time or 0.0, "max_time": self.max_time}
+
+
+class Timings(object):
+    """Time spent in named spans (Odoo calls, handler phases, table rendering), aggregated by name.
+
+    Spans can be nested; each one records its own wall time, so nested spans are also
+    included in their parents.
+    """
+
+    def __init__(self):
+        self.spans = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started_at)
+
+    def record(self, name, elapsed):
+        """Add a time measured elsewhere to the span."""
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = SpanStats()
+            stats.record(elapsed)
+
+    def timed(self, name):
+        """Decorator that runs the whole function inside a span."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+
+    def to_dict(self):
+        with self.lock:
+            return {name: stats.to_dict() for name, stats in sorted(self.spans.items())}
+
+    def summary(self):
+        spans = self.to_dict()
+        lines = ["{:<40} {:>8} {:>11} {:>11} {:>11}".format("span", "count", "total (s)", "avg (ms)", "max (ms)")]
+        for name, stats in sorted(spans.items(), key=lambda item: item[1]["total_time"], reverse=True):
+            lines.append("{:<40} {:>8} {:>11.3f} {:>11.2f} {:>11.2f}".format(name, stats["count"], stats["total_time"],
+                                                                         stats["average_time"] * 1000, stats["max_time"] * 1000))
+        return "\n".join(lines)
+
+    def dump(self, target):
+        """Write the spans as a summary to stderr ("summary") or as JSON to a file path."""
+        if target == "summary":
+            print(self.summary(), file=sys.stderr)
+            return
+        try:
+            with open(target, "w", encoding="utf-8") as f:
+                json.dump(self.to_dict(), f, indent=2)
+        except OSError as e:
+            logger.error("Timings could not be saved to '{}': '{}'".format(target, e))
+
+    def dump_at_exit(self, target):
+        if target:
+            atexit.register(self.dump, target)
+
+
+timings = Timings()
+span = timings.span
+timed = timings.timed